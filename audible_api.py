@@ -1,21 +1,34 @@
 import os
 import json
-import sys
+import time
 import asyncio
-import requests
 from getpass import getpass
 
-import pandas as pd
-import pandas.io.formats.excel
+from datetime import datetime, timezone
+
+import httpx
 import audible
+from audible.client import default_response_callback
 
 from pydub import AudioSegment
 
-import speech_recognition as sr
-from openai import OpenAI
-
 from errors import ExternalError
-from constants import artifacts_root_directory
+from utils import str_to_bool
+from library_cache import LibraryCache, LIBRARY_PAGE_SIZE
+from metadata_cache import MetadataCache
+from bookmark_store import BookmarkStore
+from transcription import get_transcriber, transcribe_all, PackedTranscriber
+from transcription_cache import TranscriptionCache, DEFAULT_CACHE_MAX_BYTES
+from report import write_transcriptions_workbook, get_book_transcriptions
+from conversion import ConversionScheduler
+from jobs import JobStore, STAGES, get_fingerprint, get_file_fingerprint
+from pipeline import Pipeline, Stage, DEFAULT_QUEUE_SIZE
+from downloader import Downloader, DEFAULT_CONCURRENCY, is_download_complete
+from metrics import metrics
+from profiling import memory_watchdog
+from constants import artifacts_root_directory, AUDIBLE_API_URL, AUDIBLE_DOWNLOAD_URL, AUDIBLE_SIDECAR_URL
+from clips import EXTRACTION_MODES, DEFAULT_CLIP_FORMAT, get_clip_format, get_clip_windows, merge_windows, \
+    prepare_audio_book, run_clip_jobs, extract_clip_job, export_clip_job, get_decoded_size, DECODE_MEMORY_FACTOR
 
 # not currently in use, but so the user can choose their store
 country_code_mapping = {
@@ -33,11 +46,26 @@ country_code_mapping = {
 
 AUDIBLE_URL_BASE = "https://www.audible"
 
-# set in ms, how long before and after the bookmark timestamp we want to slice the audioclips, useful for redundancy
-# i.e to account for the time the user spends to dig up their phone and click bookmark
-# Feel free to vary these, but free Speech Recognition API's have certain limits...
-START_POSITION_OFFSET = 10000
-END_POSITION_OFFSET = 0
+# Everything get_book_infos used to ask for, for callers that want the full item
+BOOK_INFO_RESPONSE_GROUPS = (
+    "contributors, media, price, reviews, product_attrs, "
+    "product_extended_attrs, product_desc, product_plan_details, "
+    "product_plans, rating, sample, sku, series, ws4v, origin, "
+    "relationships, review_attrs, categories, badge_types, "
+    "category_ladders, claim_code_url, is_downloaded, pdf_url, "
+    "is_returnable, origin_asin, percent_complete, provided_review"
+)
+# Downloading only needs the title
+DOWNLOAD_RESPONSE_GROUPS = "product_attrs"
+
+# Connection pool shared by all requests of an AudibleAPI instance, requests above MAX_CONCURRENT_REQUESTS wait
+# for a free slot instead of timing out waiting on the pool
+MAX_CONCURRENT_REQUESTS = 20
+CLIENT_LIMITS = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS,
+                             max_keepalive_connections=MAX_CONCURRENT_REQUESTS)
+
+# While a book is transcribed, bookmarks.json is saved at most this often (in seconds) and once at the end
+STORE_SAVE_INTERVAL = 5
 
 class AudibleAPI:
 
@@ -45,6 +73,12 @@ class AudibleAPI:
         self.auth = auth
         self.books = []
         self.library = {}
+        self.library_cache = LibraryCache()
+        self.metadata_cache = MetadataCache()
+        self.jobs = JobStore()
+        self.request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        self._client = None
+        self._async_client = None
 
     @classmethod
     async def authenticate(self) -> "AudibleAPI":
@@ -70,26 +104,52 @@ class AudibleAPI:
         print("Credentials saved locally successfully")
         return AudibleAPI(auth)
 
-    # Gets information about a book
-    async def get_book_infos(self, asin):
-        async with audible.AsyncClient(self.auth) as client:
-            try:                
-                book = await client.get(
-                    path=f"library/{asin}",
-                    params={
-                        "response_groups": (
-                            "contributors, media, price, reviews, product_attrs, "
-                            "product_extended_attrs, product_desc, product_plan_details, "
-                            "product_plans, rating, sample, sku, series, ws4v, origin, "
-                            "relationships, review_attrs, categories, badge_types, "
-                            "category_ladders, claim_code_url, is_downloaded, pdf_url, "
-                            "is_returnable, origin_asin, percent_complete, provided_review"
-                        )
-                    }
-                )
+    # One connection pooled client of each kind is shared by every request this instance makes
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = audible.Client(auth=self.auth, limits=CLIENT_LIMITS)
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = audible.AsyncClient(auth=self.auth, limits=CLIENT_LIMITS)
+        return self._async_client
+
+    async def close(self):
+        self.jobs.close()
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+    # Gets information about a book, only the response groups the caller needs are requested and the response is
+    # cached on disk (see METADATA_TTL)
+    async def get_book_infos(self, asin, response_groups=BOOK_INFO_RESPONSE_GROUPS):
+        with metrics.stage("metadata", asin=asin) as span:
+            book = self.metadata_cache.get(asin, response_groups)
+            if book is not None:
+                span.add(cache_hits=1)
                 return book
-            except Exception as e:
-                print(e)
+
+            async with self.request_semaphore:
+                try:
+                    book = await self.async_client.get(
+                        path=get_api_path(f"library/{asin}"),
+                        params={
+                            "response_groups": response_groups
+                        }
+                    )
+                    self.metadata_cache.set(asin, response_groups, book)
+                    span.add(items=1)
+                    return book
+                except Exception as e:
+                    span.status = "error"
+                    span.error = str(e)
+                    print(e)
 
     # Helper function for displaying the users books and allowing them to select one based on the index number
     async def get_book_selection(self):
@@ -98,9 +158,7 @@ class AudibleAPI:
             await self.get_library()
 
         li_books = []
-        # if not self.lib
         for index, book in enumerate(self.library["items"]):
-            li_books.append(book["asin"])
             book_title = book.get("title", "Unable to retrieve book name")
             print(f"{index}: {book_title}")
 
@@ -108,7 +166,7 @@ class AudibleAPI:
             "Enter the index number of the book you would like to download, or enter --all for all available books: \n")
 
         if book_selection == "--all":
-            li_books = [{"title": book.get("title", 'untitled'), "asin": book["asin"]}
+            li_books = [{"title": book, "asin": book["asin"]}
                         for book in self.library["items"]]
 
         else:
@@ -120,7 +178,9 @@ class AudibleAPI:
         return li_books
 
     # Main download books function
-    async def cmd_download_books(self):
+    # Interrupted downloads resume where they left off and finished ones are skipped, --verify=true re-hashes them first
+    # --segments=N fetches every book over N parallel connections, --force=true downloads finished books again
+    async def cmd_download_books(self, concurrency=DEFAULT_CONCURRENCY, verify="false", segments=1, force="false"):
         li_books = await self.get_book_selection()
 
         tasks = []
@@ -128,70 +188,71 @@ class AudibleAPI:
             tasks.append(
                 asyncio.ensure_future(
                     self.get_book_infos(
-                        book.get("asin"))))
+                        book.get("asin"), DOWNLOAD_RESPONSE_GROUPS)))
 
         books = await asyncio.gather(*tasks)
 
-        all_books = {}
-
-        for book in books:
-            if book is not None:
-                print(book["item"]["title"])
-                asin = book["item"]["asin"]
-                raw_title = book["item"]["title"]
-                title = raw_title.lower().replace(" ", "_")
-                all_books[asin] = title
+        # All books share one pooled client, at most `concurrency` of them are downloaded at the same time
+        books = [book for book in books if book is not None]
+        async with Downloader(concurrency, segments) as downloader:
+            # A book that fails doesn't stop the others, its error is reported once they are all done
+            results = await asyncio.gather(*[
+                self.download_book(book, downloader, str_to_bool(verify), str_to_bool(force))
+                for book in books
+            ], return_exceptions=True)
+
+        for book, result in zip(books, results):
+            if isinstance(result, Exception):
+                print(f"\nDownload failed for {book['item']['title']}: {result}")
+        print(f"\nDownloaded {results.count(True)} of {len(books)} books")
+
+    async def download_book(self, book, downloader, verify=False, force=False):
+        print(book["item"]["title"])
+        asin = book["item"]["asin"]
+        raw_title = book["item"]["title"]
+        title = raw_title.lower().replace(" ", "_")
+
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        title_file_path = os.path.join(title_dir_path, f"{title}.aax")
+
+        async def download():
+            if not force and await asyncio.to_thread(is_download_complete, title_file_path, verify):
+                print(f"{raw_title} is already downloaded, skipping")
+                return True
+            if force:
+                for path in [title_file_path, f"{title_file_path}.part", f"{title_file_path}.manifest.json"]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+            # Attempt to download book, the Audible client is blocking so it runs in a thread
+            try:
+                download_url = await asyncio.to_thread(
+                    self.get_download_url, self.generate_url(self.auth.locale.country_code, "download", asin),
+                    num_results=1000, response_groups="product_desc, product_attrs")
 
-                # Attempt to download book
-                try:
-                    re = self.get_download_url(self.generate_url(self.auth.locale.country_code, "download", asin), num_results=1000, response_groups="product_desc, product_attrs")
+            # Audible API throws error, usually for free books that are not allowed to be downloaded, or the request
+            # didn't get through, we skip to the next. RequestError covers all of the client's errors
+            except audible.exceptions.RequestError as e:
+                ExternalError(self.get_download_url,
+                              asin, e).show_error()
+                return False
 
-                # Audible API throws error, usually for free books that are not allowed to be downloaded, we skip to the next
-                except audible.exceptions.NetworkError as e:
-                    ExternalError(self.get_download_url,
-                                  asin, e).show_error()
-                    continue
+            try:
+                os.makedirs(title_dir_path, exist_ok=True)
+                return await downloader.download(str(download_url), title_file_path, raw_title)
+            except OSError as e:
+                print(f"\nError while writing {raw_title}: {e}")
+                return False
 
-                audible_response = requests.get(re, stream=True)
-
-                title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-                path_exists = os.path.exists(title_dir_path)
-                if not path_exists:
-                    os.makedirs(title_dir_path)
-                    
-
-                if audible_response.ok:
-                    title_file_path = os.path.join(title_dir_path, f"{title}.aax")
-                    with open(title_file_path, 'wb') as f:
-                        print("Downloading %s" % raw_title)
-
-                        total_length = audible_response.headers.get(
-                            'content-length')
-
-                        if total_length is None:  # no content length header
-                            print(
-                                "Unable to estimate download size, downloading, this might take a while...")
-                            f.write(audible_response.content)
-                        else:
-                            # Save book locally and calculate and print download progress (progress bar)
-                            dl = 0
-                            total_length = int(total_length)
-                            for data in audible_response.iter_content(chunk_size=1024*1024):
-                                dl += len(data)
-                                f.write(data)
-                                done = int(50 * dl / total_length)
-                                sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)))
-
-                                sys.stdout.write(f"   {int(dl / total_length * 100)}%")
-                                sys.stdout.flush()
-
-                else:
-                    print(audible_response.text)
+        # --verify re-hashes the book, so it doesn't take the job database's word for it
+        return await self.jobs.run(asin, "download", raw_title, get_fingerprint(asin), download,
+                                   outputs=[title_file_path], force=force or verify)
 
     # WIP
     def generate_url(self, country_code, url_type, asin=None):
         if asin and url_type == "download":
-            return f"{AUDIBLE_URL_BASE}{country_code_mapping.get(country_code)}/library/download?asin={asin}&codec=AAX"
+            url_base = AUDIBLE_DOWNLOAD_URL or f"{AUDIBLE_URL_BASE}{country_code_mapping.get(country_code)}"
+            return f"{url_base}/library/download?asin={asin}&codec=AAX"
 
     # Need the next_request for Audible API to give us the download link for the book
     def get_download_link_callback(self, resp):
@@ -199,13 +260,13 @@ class AudibleAPI:
 
     # Sends a request to get the download link for the selected book
     def get_download_url(self, url, **kwargs):
-
-        with audible.Client(auth=self.auth, response_callback=self.get_download_link_callback) as client:
-            library = client.get(
+        with metrics.stage("url_resolution"):
+            library = self.client.get(
                 url,
+                response_callback=self.get_download_link_callback,
                 **kwargs
             )
-            return library.url
+        return library.url
 
     async def cmd_list_books(self):
         if not self.books:
@@ -214,22 +275,65 @@ class AudibleAPI:
         await self.cmd_show_library()
         
     # Gets all books and info for account and adds it to self.books, also returns ASIN for all books
-    async def get_library(self):
-        async with audible.AsyncClient(self.auth) as client:
-            self.library = await client.get(
-                path="library",
-                params={
-                    "num_results": 999
-                }
-            )
-            asins = [book["asin"] for book in self.library["items"]]
-
-            for book in self.library["items"]:
-                asins.append(book["asin"])
-                book_title = book.get("title", "Unable to retrieve book name")
-                self.books.append(book_title)
+    # The library is read from the local snapshot, the API is only used when there is no snapshot (full sync) or it's
+    # older than LIBRARY_MAX_AGE (only the books purchased since the last sync are fetched)
+    async def get_library(self, refresh=False):
+        snapshot = self.library_cache.load()
+        now = datetime.now(timezone.utc)
+
+        if snapshot is None or refresh == "full":
+            items = await self.fetch_library_pages()
+            self.library_cache.save(items, now)
+        elif str_to_bool(refresh) or LibraryCache.is_stale(snapshot, now):
+            new_items = await self.fetch_library_pages(
+                purchased_after=LibraryCache.get_purchased_after(snapshot))
+            items = LibraryCache.merge(snapshot["items"], new_items)
+            self.library_cache.save(items, now)
+        else:
+            items = snapshot["items"]
+
+        self.library = {"items": items}
+        self.books = [book.get("title", "Unable to retrieve book name") for book in items]
+        return [book["asin"] for book in items]
+
+    # Fetches the first page, and when the library is bigger than a page, all the remaining pages concurrently
+    async def fetch_library_pages(self, **params):
+        async def get_page(page):
+            async with self.request_semaphore:
+                return await self.async_client.get(
+                    path=get_api_path("library"),
+                    params={
+                        "num_results": LIBRARY_PAGE_SIZE,
+                        "page": page,
+                        **params
+                    },
+                    response_callback=library_page_response_callback
+                )
 
-            return asins
+        with metrics.stage("library_fetch", incremental=bool(params)) as span:
+            first_page, total_count = await get_page(1)
+            items = first_page.get("items", [])
+            if total_count is None:
+                # No total to go by, keep going one page at a time until we get a short one
+                page = 1
+                while len(first_page.get("items", [])) == LIBRARY_PAGE_SIZE:
+                    page += 1
+                    first_page, _ = await get_page(page)
+                    items += first_page.get("items", [])
+                span.add(pages=page, items=len(items))
+                return items
+
+            num_pages = -(-total_count // LIBRARY_PAGE_SIZE)
+            pages = await asyncio.gather(*[get_page(page) for page in range(2, num_pages + 1)])
+            for page, _ in pages:
+                items += page.get("items", [])
+            span.add(pages=max(num_pages, 1), items=len(items))
+            return items
+
+    # Re-downloads the whole library snapshot (--full=true) or only what was purchased since the last sync
+    async def cmd_sync_library(self, full="false"):
+        await self.get_library(refresh="full" if str_to_bool(full) else True)
+        print(f"Library synced, {len(self.books)} books")
 
     async def cmd_show_library(self):
         if not self.books:
@@ -239,224 +343,458 @@ class AudibleAPI:
             print(f"{index}: {book_title}")
    
 
-    async def cmd_get_bookmarks(self):
+    # --merge=true cuts overlapping bookmark windows as one span, every bookmark gets its part of the transcription
+    # --clip_format picks the codec, sample rate and channels of the clips (see CLIP_FORMATS), --sample_rate and
+    # --channels override the ones of the preset
+    # --force=true extracts the clips of books that were already done again
+    async def cmd_get_bookmarks(self, mode="seek", workers=None, merge="false", clip_format=DEFAULT_CLIP_FORMAT,
+                                sample_rate=None, channels=None, force="false"):
+        if mode not in EXTRACTION_MODES:
+            print(f"Invalid mode {mode}, choose one of: {', '.join(EXTRACTION_MODES)}")
+            return
+        try:
+            clip_format = get_clip_format(clip_format, sample_rate, channels)
+        except ValueError as e:
+            print(e)
+            return
+
         li_books = await self.get_book_selection()
 
         for book in li_books:
-            print(self.get_bookmarks(book))
+            self.get_bookmarks(book, mode=mode, workers=workers, merge=str_to_bool(merge), clip_format=clip_format,
+                               force=str_to_bool(force))
 
-    def get_bookmarks(self, book):
+    # Clips are encoded in a process pool of `workers` processes (defaults to the number of cores)
+    # Returns False when the book has no audio to cut clips from or some clips failed
+    def get_bookmarks(self, book, mode="seek", workers=None, merge=False, clip_format=None, force=False):
         asin = book.get("asin")
         _title = book.get("title", {}).get("title", 'untitled')
         if not _title:
-            return
+            return False
 
         title = _title.lower().replace(" ", "_")
 
-        bookmarks_url = f"https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key={asin}"
+        bookmarks_url = f"{AUDIBLE_SIDECAR_URL}?type=AUDI&key={asin}"
         print(f"Getting bookmarks for {_title}")
-        with audible.Client(auth=self.auth, response_callback=self.bookmark_response_callback) as client:
-            library = client.get(
+        with metrics.stage("sidecar", book=_title) as span:
+            library = self.client.get(
                 bookmarks_url,
+                response_callback=self.bookmark_response_callback,
                 num_results=1000,
                 response_groups="product_desc, product_attrs"
             )
 
             li_bookmarks = library.json().get("payload", {}).get("records", [])
-            li_clips = sorted(
-                li_bookmarks, key=lambda i: i["type"], reverse=True)
-
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
-            title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
-            title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
-
-            # Load audiobook into AudioSegment so we can slice it
-            audio_book = AudioSegment.from_mp3(
-                title_mp3_path)
-
-            file_counter = 1
-            notes_dict = {}
-
-            # Check whether a folder in clips/ for the book exists or not
-            clips_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title, "clips")
-            path_exists = os.path.exists(clips_dir_path)
-            if not path_exists:
-                os.makedirs(clips_dir_path)
-
-            for audio_clip in li_clips:
-                # Get start position to slice
-                raw_start_pos = int(audio_clip["startPosition"])
-
-                # If we have a note then we save it so we can use it as the title for the bookmark text
-                if audio_clip.get("type", None) in ["audible.note"]:
-                    notes_dict[raw_start_pos] = audio_clip.get("text")
-                    print(
-                        f"CLIP: {notes_dict[raw_start_pos]}  {raw_start_pos}")
-
-                if audio_clip.get("type", None) in ["audible.clip", "audible.bookmark"]:
-                    start_pos = raw_start_pos - START_POSITION_OFFSET
-                    end_pos = int(audio_clip.get(
-                        "endPosition", raw_start_pos + 30000)) + END_POSITION_OFFSET
-                    if start_pos == end_pos:
-                        end_pos += 30000
-
-                    # Slice it up
-                    clip = audio_book[start_pos:end_pos]
-
-                    file_name = notes_dict.get(
-                        raw_start_pos, f"clip{file_counter}")
-
-                    # Save the clip
-                    clip_path = os.path.join(clips_dir_path, f"{file_name}.flac")
-                    clip.export(
-                        clip_path, format="flac")
-                    file_counter += 1
-
-    async def cmd_convert_audiobook(self):
+            span.add(bytes=len(library.content), items=len(li_bookmarks))
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        clip_format = clip_format or get_clip_format()
+
+        # Nothing to do while the records and the way they are cut stay the same, and the clips are still there
+        fingerprint = get_fingerprint(li_bookmarks, merge, clip_format)
+        store = BookmarkStore(title_dir_path)
+        outputs = [store.path] + [store.get_clip_path(audio_name) for audio_name in store.get_extracted()]
+        return self.jobs.run_sync(
+            asin, "get_bookmarks", _title, fingerprint,
+            lambda: self.extract_bookmarks(li_bookmarks, title_dir_path, _title, title, mode, workers, merge,
+                                           clip_format),
+            outputs=outputs, force=force)
+
+    def extract_bookmarks(self, li_bookmarks, title_dir_path, _title, title, mode, workers, merge, clip_format):
+        clip_windows = get_clip_windows(li_bookmarks)
+
+        # Only the bookmarks we haven't extracted in an earlier run are sliced
+        store = BookmarkStore(title_dir_path)
+        clip_windows = store.sync(clip_windows, clip_format["extension"])
+        if merge:
+            clip_windows = store.attach_to_spans(clip_windows)
+        store.save()
+        if not clip_windows:
+            print(f"No new bookmarks for {_title}")
+            return True
+
+        source_path, input_args = self.get_audio_source(title_dir_path, title, allow_aax=mode == "seek")
+        if not source_path:
+            print(f"No audiobook found for {_title} in {title_dir_path}, run download_books first")
+            return False
+
+        # With a --memory_budget_mb the whole book has to fit in what's left of it, otherwise it's cut in seek mode
+        headroom = memory_watchdog.get_headroom()
+        if mode == "decode" and headroom is not None:
+            decoded_size = get_decoded_size(source_path, input_args)
+            if decoded_size and decoded_size * DECODE_MEMORY_FACTOR > headroom:
+                print(f"Decoding {_title} takes about {decoded_size * DECODE_MEMORY_FACTOR / (1024 * 1024):.0f} MB, "
+                      f"more than the memory budget leaves, cutting its clips in seek mode instead")
+                mode = "seek"
+
+        # Check whether a folder in clips/ for the book exists or not
+        clips_dir_path = os.path.join(title_dir_path, "clips")
+        path_exists = os.path.exists(clips_dir_path)
+        if not path_exists:
+            os.makedirs(clips_dir_path)
+
+        # Overlapping windows are cut once as a span instead of once per bookmark, also across runs
+        if merge:
+            clip_windows = store.reopen_overlapping(clip_windows, clip_format["extension"])
+            audio_files = store.add_spans(merge_windows(clip_windows), clip_format["extension"])
+        else:
+            audio_files = [(file_name, start_pos, end_pos) for file_name, start_pos, end_pos, _ in clip_windows]
+
+        with metrics.stage("slice_export", book=_title, mode=mode, codec=clip_format["codec"]) as span:
+            if mode == "seek":
+                # Only the bytes of each bookmark window get decoded, the book itself is never loaded
+                failed = run_clip_jobs(extract_clip_job, (
+                    (audio_name, source_path, store.get_clip_path(audio_name),
+                     start_pos, end_pos, input_args, clip_format)
+                    for audio_name, start_pos, end_pos in audio_files
+                ), workers)
+            else:
+                # Load audiobook into AudioSegment so we can slice it, downmixed and resampled once for all clips
+                audio_book = prepare_audio_book(AudioSegment.from_file(
+                    source_path), clip_format)
+
+                # Slice it up, the slices are encoded to flac in the worker processes
+                failed = run_clip_jobs(export_clip_job, (
+                    (audio_name, audio_book[start_pos:end_pos].raw_data, audio_book.sample_width,
+                     audio_book.frame_rate, audio_book.channels, store.get_clip_path(audio_name), clip_format)
+                    for audio_name, start_pos, end_pos in audio_files
+                ), workers)
+
+            for audio_name, _, _ in audio_files:
+                if audio_name not in failed:
+                    store.mark_extracted(audio_name)
+                    span.add(items=1, bytes=os.path.getsize(store.get_clip_path(audio_name)))
+            span.add(failed=len(failed))
+        store.save()
+        print(f"Extracted {len(audio_files) - len(failed)} new audio files for {len(clip_windows)} bookmarks of {_title}")
+        return not failed
+
+    # Picks the file to cut clips from, the decrypted .m4b is preferred, then the .aax (decrypted on the fly with the
+    # activation bytes, ffmpeg only) and finally a legacy .mp3. Returns the path and the ffmpeg input arguments it needs
+    def get_audio_source(self, title_dir_path, title, allow_aax=True):
+        title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
+        title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
+        title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
+
+        if os.path.exists(title_m4b_path):
+            return title_m4b_path, []
+        if allow_aax and os.path.exists(title_aax_path):
+            return title_aax_path, ["-activation_bytes", self.get_activation_bytes()]
+        if os.path.exists(title_mp3_path):
+            return title_mp3_path, []
+        return None, []
+
+    # Books are converted in parallel, --jobs=N runs up to N ffmpeg processes at once (defaults to the number of cores)
+    # --force=true converts books that were already converted again
+    async def cmd_convert_audiobook(self, mp3="false", jobs=None, force="false"):
         # FFMPEG needs to be installed for this step! see readme for more details
         li_books = await self.get_book_selection()
+        if not li_books:
+            return
 
-        for book in li_books:
-            asin = book.get("asin")
-            # Weird for some reason the title is doubled nested here, fix later
-            _title = book.get("title", {}).get("title", {})
-            if not _title:
-                return
-
-            title = _title.replace(" ", "_").lower()
-            # Strips Audible DRM  from audiobook
-            activation_bytes = self.get_activation_bytes()
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
-            title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
-            title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
-            os.system(
-                f"ffmpeg -activation_bytes {activation_bytes} -i {title_aax_path} -c copy {title_m4b_path}")
-
-            # Converts audiobook to .mp3
-            os.system(
-                f"ffmpeg -i {title_m4b_path} {title_mp3_path}")
-
-    async def cmd_transcribe_bookmarks(self, openai_api_key=None):
-        li_books = await self.get_book_selection()
-
-        # Initialize OpenAI client if API key is provided, otherwise fall back to Google
-        use_openai = openai_api_key is not None
-        if use_openai:
-            client = OpenAI(api_key=openai_api_key)
-            print("Using OpenAI Whisper API for transcription")
-        else:
-            r = sr.Recognizer()
-            print("Using Google Speech Recognition for transcription (no API key required)")
+        # Strips Audible DRM  from audiobook, the activation bytes are the same for every book
+        activation_bytes = await asyncio.to_thread(self.get_activation_bytes)
+        scheduler = ConversionScheduler(jobs)
+        results = await asyncio.gather(*[
+            self.convert_book(book, scheduler, activation_bytes, str_to_bool(mp3), str_to_bool(force))
+            for book in li_books
+        ], return_exceptions=True)
+
+        for book, result in zip(li_books, results):
+            if isinstance(result, Exception):
+                print(f"\nConversion failed for {book.get('title', {}).get('title')}: {result}")
+        print(f"\nConverted {results.count(True)} of {len(li_books)} books")
+
+    # Returns False when ffmpeg failed, outputs that are newer than their input are kept
+    async def convert_book(self, book, scheduler, activation_bytes, mp3=False, force=False):
+        asin = book.get("asin")
+        # Weird for some reason the title is doubled nested here, fix later
+        _title = book.get("title", {}).get("title", {})
+        if not _title:
+            return False
+
+        title = _title.replace(" ", "_").lower()
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
+        title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
+        title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
+
+        async def convert():
+            if force or is_outdated(title_m4b_path, title_aax_path):
+                if not os.path.exists(title_aax_path):
+                    print(f"No .aax found for {_title} in {title_dir_path}, run download_books first")
+                    return False
+                if not await scheduler.run(
+                        _title, ["-activation_bytes", activation_bytes, "-i", title_aax_path, "-c", "copy"],
+                        title_m4b_path):
+                    return False
+
+            # Clips are cut straight from the .m4b, the full re-encode to .mp3 is only done when asked for
+            if mp3 and (force or is_outdated(title_mp3_path, title_m4b_path)):
+                return await scheduler.run(f"{_title} (mp3)", ["-i", title_m4b_path], title_mp3_path)
+            return True
+
+        fingerprint = get_fingerprint(get_file_fingerprint(title_aax_path), mp3)
+        outputs = [title_m4b_path, title_mp3_path] if mp3 else [title_m4b_path]
+        return await self.jobs.run(asin, "convert", _title, fingerprint, convert, outputs=outputs, force=force)
+
+    # Clips are transcribed by a pool of --concurrency workers, --rpm caps the requests per minute sent to the backend
+    # Transcriptions are cached by clip audio, --cache_size_mb limits how big that cache grows
+    # --backend=local transcribes offline on the CPU (--model, --batch_size clips per inference call)
+    # --pack=N sends up to N clips as one request, separated by silence, and splits the transcript back up
+    # --force=true transcribes the clips of books that were already done again
+    async def cmd_transcribe_bookmarks(self, openai_api_key=None, concurrency=None, rpm=None,
+                                       cache_size_mb=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024),
+                                       backend=None, model=None, batch_size=None, pack=None, force="false"):
+        transcriber = self.create_transcriber(openai_api_key, concurrency, rpm, backend, model, batch_size, pack)
+        if transcriber is None:
+            return
 
-        # Create dictionary to store titles and transcriptions and new folder to store transcriptions
-        pairs = {}
-        jsonHighlights = []
-        
+        li_books = await self.get_book_selection()
+        cache = TranscriptionCache(max_bytes=float(cache_size_mb) * 1024 * 1024)
+        try:
+            await self.transcribe_books(li_books, transcriber, cache, str_to_bool(force))
+        finally:
+            await transcriber.close()
+            cache.report()
+            cache.close()
+
+    # Initialize OpenAI client if API key is provided, otherwise fall back to Google. None when the backend can't be
+    # used, the reason is printed
+    def create_transcriber(self, openai_api_key=None, concurrency=None, rpm=None, backend=None, model=None,
+                           batch_size=None, pack=None):
+        try:
+            transcriber = get_transcriber(openai_api_key, backend, model, concurrency=concurrency,
+                                          requests_per_minute=rpm, batch_size=batch_size)
+        except (ImportError, ValueError) as e:
+            print(e)
+            return None
+        if pack and int(pack) > 1:
+            transcriber = PackedTranscriber(transcriber, int(pack))
+        return transcriber
+
+    async def transcribe_books(self, li_books, transcriber, cache=None, force=False):
         for book in li_books:
+            await self.transcribe_book(book, transcriber, cache, force)
+        self.write_transcriptions_report()
 
-            _title = book.get("title", {}).get("title", {})
-            _authors = book.get("title", {}).get("authors", {})
-            allAuthors = ", ".join(item['name'] for item in _authors)
-            title = _title.lower().replace(" ", "_")
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            clips_dir_path = os.path.join(title_dir_path, "clips")
-            directory = os.fsencode(clips_dir_path)
-
-            path_exists = os.path.exists(directory)
-            if not path_exists:
-                os.makedirs(directory)
-
-            transcribed_clips_dir_path = os.path.join(title_dir_path, "trancribed_clips")
-            trancribed_clips_path_exists = os.path.exists(transcribed_clips_dir_path)
-            if not trancribed_clips_path_exists:
-                os.makedirs(transcribed_clips_dir_path)
-
-            for file in os.listdir(directory):
-                highlight = {}
-                filename = os.fsdecode(file)
-                highlight["title"] = _title
-                highlight["author"] = allAuthors
-                if not filename.startswith("clip"):
-                    highlight["note"] = filename.replace(".flac", "")
-                highlight["source_type"] = "audible_bookmark_extractor"
-                if filename.endswith(".flac"):
-                    print(os.path.join(os.fsdecode(directory), filename))
-                    heading = filename.replace(".flac", "")
-
-                    try:
-                        if use_openai:
-                            # Use OpenAI Whisper API
-                            audio_file_path = os.path.join(os.fsdecode(directory), filename)
-                            with open(audio_file_path, "rb") as audio_file:
-                                transcription = client.audio.transcriptions.create(
-                                    model="gpt-4o-transcribe",
-                                    file=audio_file
-                                )
-                                text = transcription.text
-                        else:
-                            # Use Google Speech Recognition
-                            audioclip = sr.AudioFile(os.path.join(
-                                os.fsdecode(directory), filename))
-                            with audioclip as source:
-                                audio = r.record(source)
-                            text = r.recognize_google(audio)
-                        
-                        pairs[str(heading)] = text
-                        highlight["text"] = text
-                    except Exception as e:
-                        highlight["text"] = ""
-                        print(f"Error while recognizing this clip {heading}: {e}")
-                    
-                    xcel = pd.DataFrame(pairs.values(), index=pairs.keys())
-
-                    # Change header format so that rows can be edited
-                    pandas.io.formats.excel.ExcelFormatter.header_style = None
+    # Transcribes the new clips of a book and writes its highlights to contents.json, returns False when some
+    # clips could not be transcribed
+    async def transcribe_book(self, book, transcriber, cache=None, force=False):
+        asin = book.get("asin")
+        _title = book.get("title", {}).get("title", {})
+        _authors = book.get("title", {}).get("authors", {})
+        allAuthors = ", ".join(item['name'] for item in _authors)
+        title = _title.lower().replace(" ", "_")
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        transcribed_clips_dir_path = os.path.join(title_dir_path, "trancribed_clips")
+        trancribed_clips_path_exists = os.path.exists(transcribed_clips_dir_path)
+        if not trancribed_clips_path_exists:
+            os.makedirs(transcribed_clips_dir_path)
+
+        # Clips transcribed in an earlier run keep their stored text, only the new ones are sent off
+        store = BookmarkStore(title_dir_path)
+        store.add_untracked_clips()
+        if force:
+            store.reset_transcriptions()
+
+        async def transcribe():
+            with metrics.stage("transcription", book=_title, backend=transcriber.name,
+                               model=transcriber.model) as span:
+                untranscribed = store.get_untranscribed()
+                print(f"{len(untranscribed)} new clips to transcribe for {_title}")
+                # Deleted clips are left out, the stage fails so it's retried once get_bookmarks cut them again
+                missing = store.get_missing()
+                if missing:
+                    print(f"{len(missing)} clips of {_title} are missing, run get_bookmarks again to cut them")
+                span.add(items=len(untranscribed),
+                         bytes=sum(os.path.getsize(store.get_clip_path(heading)) for heading in untranscribed))
+                jsonHighlights = []
+                errors = []
+                saved_at = time.monotonic()
+
+                # All new clips go through the worker pool, each result is stored as soon as it comes in and
+                # written to disk every few seconds
+                def on_result(index, transcript, error):
+                    nonlocal saved_at
+                    heading = untranscribed[index]
+                    if error is not None:
+                        print(f"Error while recognizing this clip {heading}: {error}")
+                        errors.append(heading)
+                        return
+                    print(f"Transcribed {heading}")
+                    store.set_transcription(heading, transcript)
+                    if time.monotonic() - saved_at >= STORE_SAVE_INTERVAL:
+                        store.save()
+                        saved_at = time.monotonic()
 
+                try:
+                    await transcribe_all(transcriber, [store.get_clip_path(heading) for heading in untranscribed],
+                                         on_result, cache)
+                finally:
+                    store.save()
+                # Clips that came back without text stay untranscribed, the stage fails so they are sent again
+                empty = [heading for heading in store.get_untranscribed() if heading not in errors]
+                if empty:
+                    print(f"{len(empty)} clips of {_title} came back without text, they are retried on the next run")
+
+                for heading, clip in store.clips.items():
+                    if not clip["extracted"]:
+                        continue
+
+                    highlight = {}
+                    highlight["title"] = _title
+                    highlight["author"] = allAuthors
+                    if not heading.startswith("clip"):
+                        highlight["note"] = heading
+                    highlight["source_type"] = "audible_bookmark_extractor"
+
+                    highlight["text"] = clip["text"] or ""
                     if highlight["text"]:
                         jsonHighlights.append(highlight)
-                    
-                    # Create writer instance with desired path
-                    all_transcriptions_path = os.path.join(transcribed_clips_dir_path, "All_Transcriptions.xlsx")
-                    writer = pd.ExcelWriter(
-                        all_transcriptions_path, engine='xlsxwriter')
-
-                    # Create a sheet in the same workbook for each file in the directory
-                    sheet_name = title[:31].replace(":", "").replace("?", "")
-                    xcel.to_excel(writer, sheet_name=sheet_name)
-                    workbook = writer.book
-                    worksheet = writer.sheets[sheet_name]
-
-                    # Create header format to be used in all headers
-                    header_format = workbook.add_format({
-                        "valign": "vcenter",
-                        "align": "center",
-                        "bg_color": "#FFA500",
-                        "bold": True,
-                        "font_color": "#FFFFFF"})  # transcribe_bookmarks
-
-                    # Set desired cell format
-                    cell_format = workbook.add_format()
-                    cell_format.set_align("vcenter")
-                    cell_format.set_align("center")
-                    cell_format.set_text_wrap(True)
-
-                    # Apply header format and format columns to fit data
-                    worksheet.write(0, 0, 'Clip Note', header_format)
-                    worksheet.write(0, 1, 'Transcription', header_format)
-                    worksheet.set_column("B:B", 100)
-                    worksheet.set_column("A:A", 50)
-
-                    # Format cells for appropiate size, wrap the text for style points
-                    for i in range(1, (len(xcel)+1)):
-                        worksheet.set_row(i, 100, cell_format)
-
-                    # Apply changes and save xlsx to Transcribed bookmarks folder.
-                    writer.close()
-            transcription_contents_path = os.path.join(transcribed_clips_dir_path, "contents.json")
-            with open(transcription_contents_path, "w") as f:
-                json.dump(jsonHighlights, f, indent=4)                
+
+                transcription_contents_path = os.path.join(transcribed_clips_dir_path, "contents.json")
+                with open(transcription_contents_path, "w") as f:
+                    json.dump(jsonHighlights, f, indent=4)
+                span.add(failed=len(errors) + len(empty), highlights=len(jsonHighlights))
+                return not errors and not missing and not empty
+
+        # The same clips with the same backend and model give the same transcriptions
+        fingerprint = get_fingerprint(
+            transcriber.name, transcriber.model,
+            sorted([clip["key"], clip.get("span"), clip["extracted"]] for clip in store.clips.values()))
+        return await self.jobs.run(asin, "transcribe", _title, fingerprint, transcribe,
+                                   outputs=[os.path.join(transcribed_clips_dir_path, "contents.json")], force=force)
+
+    # The workbook is written once at the end, with a sheet for every book we have transcriptions for
+    def write_transcriptions_report(self):
+        audiobooks_dir_path = os.path.join(artifacts_root_directory, "audiobooks")
+        all_transcriptions_path = os.path.join(audiobooks_dir_path, "All_Transcriptions.xlsx")
+        write_transcriptions_workbook(all_transcriptions_path, get_book_transcriptions(audiobooks_dir_path))
+        print(f"Transcriptions saved to {all_transcriptions_path}")
+
+    # Runs the selected books through download -> convert -> get_bookmarks -> transcribe -> Readwise -> Notion as a
+    # pipeline, so the stages of different books overlap. --queue_size=N books can wait between two stages, the other
+    # options are the ones of the single stage commands (--concurrency and --segments of download_books, --convert_jobs is the
+    # --jobs of convert_audiobook, --transcribe_concurrency is the --concurrency of transcribe_bookmarks). Stages a
+    # book already went through are skipped, --force=true runs all of them again
+    async def cmd_sync(self, readwise=None, notion=None, openai_api_key=None, queue_size=DEFAULT_QUEUE_SIZE,
+                       concurrency=DEFAULT_CONCURRENCY, segments=1, mode="seek", workers=None, merge="false",
+                       clip_format=DEFAULT_CLIP_FORMAT, sample_rate=None, channels=None, transcribe_concurrency=None,
+                       rpm=None, cache_size_mb=DEFAULT_CACHE_MAX_BYTES // (1024 * 1024), backend=None, model=None,
+                       batch_size=None, pack=None, convert_jobs=None, force="false"):
+        if mode not in EXTRACTION_MODES:
+            print(f"Invalid mode {mode}, choose one of: {', '.join(EXTRACTION_MODES)}")
+            return
+        try:
+            clip_format = get_clip_format(clip_format, sample_rate, channels)
+        except ValueError as e:
+            print(e)
+            return
+        transcriber = self.create_transcriber(openai_api_key, transcribe_concurrency, rpm, backend, model,
+                                              batch_size, pack)
+        if transcriber is None:
+            return
+
+        li_books = await self.get_book_selection()
+        cache = TranscriptionCache(max_bytes=float(cache_size_mb) * 1024 * 1024)
+        force = str_to_bool(force)
+
+        async def download(book):
+            infos = await self.get_book_infos(book.get("asin"), DOWNLOAD_RESPONSE_GROUPS)
+            return infos is not None and await self.download_book(infos, downloader, force=force)
+
+        async def convert(book):
+            return await self.convert_book(book, scheduler, activation_bytes, force=force)
+
+        # The blocking stages run in threads so they don't hold up the event loop the other stages run on
+        async def get_bookmarks(book):
+            return await asyncio.to_thread(self.get_bookmarks, book, mode, workers, str_to_bool(merge), clip_format,
+                                           force)
+
+        # Clips that failed are left for the next run (the job stays failed), the highlights of the ones that worked
+        # still go on to the exports as soon as contents.json is written
+        async def transcribe(book):
+            if await self.transcribe_book(book, transcriber, cache, force):
+                return True
+            title = book.get("title", {}).get("title", "").lower().replace(" ", "_")
+            contents_path = os.path.join(artifacts_root_directory, "audiobooks", title, "trancribed_clips",
+                                         "contents.json")
+            if not os.path.exists(contents_path):
+                return False
+            print(f"Exporting the highlights of {book.get('title', {}).get('title')} that were transcribed, "
+                  f"the other clips are retried on the next sync")
+            return True
+
+        async def post_highlights(book):
+            return await readwise.post_book_highlights(book, force)
+
+        async def export_to_notion(book):
+            return await notion.post_book_highlights(book, force)
+
+        activation_bytes = await asyncio.to_thread(self.get_activation_bytes)
+        scheduler = ConversionScheduler(convert_jobs)
+        stages = [
+            Stage("download", download, concurrency),
+            Stage("convert", convert, scheduler.jobs),
+            Stage("get_bookmarks", get_bookmarks),
+            Stage("transcribe", transcribe),
+        ]
+        if readwise is not None:
+            stages.append(Stage("readwise", post_highlights))
+        else:
+            print("No Readwise Token found, highlights won't be posted")
+        if notion is not None:
+            stages.append(Stage("notion", export_to_notion))
+
+        pipeline = Pipeline(stages, queue_size, get_label=lambda book: book.get("title", {}).get("title", "untitled"))
+        try:
+            async with Downloader(concurrency, segments) as downloader:
+                await pipeline.run(li_books)
+            self.write_transcriptions_report()
+        finally:
+            await transcriber.close()
+            cache.report()
+            cache.close()
+            if readwise is not None:
+                await readwise.close()
+            if notion is not None:
+                await notion.close()
+        pipeline.report()
+
+    # Where every book is at, with how long its last run of each stage took
+    async def cmd_show_jobs(self):
+        jobs = self.jobs.get_all()
+        if not jobs:
+            print("No jobs recorded yet")
+            return
+
+        books = {}
+        for job in jobs:
+            books.setdefault((job["title"], job["asin"]), {})[job["stage"]] = job
+        for (title, asin), stages in books.items():
+            print(f"{title} ({asin})")
+            for stage in STAGES:
+                job = stages.get(stage)
+                if job is None:
+                    continue
+                duration = f"{job['finished_at'] - job['started_at']:.1f}s" if job["finished_at"] else "-"
+                error = f", {job['error']}" if job["error"] else ""
+                print(f"  {stage}: {job['status']} ({duration}{error})")
+
+    # Where the last command spent its time, per stage, from the metrics (see metrics.py)
+    async def cmd_show_metrics(self):
+        run = metrics.get_last_run()
+        if run is None:
+            print(f"No metrics recorded yet, they are written to {metrics.path}")
+            return
+
+        print(f"{run['command']} took {run['seconds']:.1f}s")
+        for stage, totals in sorted(run["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            counts = ", ".join(f"{key} {value}" for key, value in totals.items()
+                               if key not in ["runs", "seconds", "errors"])
+            errors = f", {totals['errors']} failed" if totals["errors"] else ""
+            print(f"  {stage}: {totals['seconds']:.1f}s over {totals['runs']} runs{errors}"
+                  f"{f' ({counts})' if counts else ''}")
 
     def get_activation_bytes(self):
 
@@ -464,7 +802,7 @@ class AudibleAPI:
         # we already have activation bytes
         if os.path.exists(activation_bytes_path):
             with open(activation_bytes_path) as f:
-                activation_bytes = f.readlines()[0]
+                activation_bytes = f.readlines()[0].strip()
 
         # we don't, so let's get them
         else:
@@ -478,3 +816,23 @@ class AudibleAPI:
 
     def bookmark_response_callback(self, resp):
         return resp
+
+
+# API paths as the Audible client takes them, made absolute when AUDIBLE_API_URL points somewhere else
+def get_api_path(path):
+    if AUDIBLE_API_URL:
+        return f"{AUDIBLE_API_URL.rstrip('/')}/1.0/{path}"
+    return path
+
+
+# True when output is missing or older than the input it was made from
+def is_outdated(output_path, input_path):
+    if not os.path.exists(output_path):
+        return True
+    return os.path.exists(input_path) and os.path.getmtime(input_path) > os.path.getmtime(output_path)
+
+
+# Library pages come back with the size of the whole library in the Total-Count header
+def library_page_response_callback(resp):
+    total_count = resp.headers.get("total-count")
+    return default_response_callback(resp), int(total_count) if total_count else None
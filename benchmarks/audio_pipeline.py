@@ -0,0 +1,247 @@
+# Offline benchmark of the audio hot paths: clip extraction (get_bookmarks), clip encoding, and the contents.json and
+# All_Transcriptions.xlsx output of transcribe_bookmarks with a stub transcriber. Runs against a synthetic audiobook
+# and sidecar records, nothing goes to the network.
+#
+#   python benchmarks/audio_pipeline.py --hours=3 --bookmarks_per_hour=60 --save     record a baseline
+#   python benchmarks/audio_pipeline.py --hours=3 --bookmarks_per_hour=60 --compare  compare against it
+#
+# --compare exits with 1 when a benchmark got slower or used more memory than the baseline allows (--tolerance)
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+
+# Point the artifacts directory at the work directory before anything from the app is imported, so a benchmark run
+# never touches real books, caches or the job database
+WORK_DIR_ARG = [arg.split("=", 1)[1] for arg in sys.argv if arg.startswith("--workdir=")]
+WORK_DIR = os.path.abspath(WORK_DIR_ARG[0] if WORK_DIR_ARG else os.path.join(tempfile.gettempdir(), "audible-bench"))
+os.environ["AUDIBLE_ARTIFACTS_DIR"] = os.path.join(WORK_DIR, "audible-bookmark-extractor")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audible_api import AudibleAPI  # noqa: E402
+from clips import get_clip_format  # noqa: E402
+from constants import artifacts_root_directory  # noqa: E402
+from transcription import Transcriber, Transcript  # noqa: E402
+
+BENCH_TITLE = "Synthetic Benchmark Book"
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "audio_pipeline.json")
+# Allowed slowdown (and memory growth) over the baseline before --compare fails
+DEFAULT_TOLERANCE = 0.2
+# Differences below these are noise, whatever the ratio
+MIN_DELTAS = {"seconds": 0.05, "peak_mb": 1}
+STUB_TEXT = "the quick brown fox jumps over the lazy dog " * 8
+
+
+# Answers every clip right away, so only our own bookkeeping and output writing is measured
+class StubTranscriber(Transcriber):
+    name = "stub"
+    model = "stub"
+    concurrency = 16
+
+    async def transcribe(self, path):
+        return Transcript(STUB_TEXT.strip())
+
+
+def get_title_dir_path():
+    return os.path.join(artifacts_root_directory, "audiobooks", BENCH_TITLE.lower().replace(" ", "_"))
+
+
+# A multi hour stereo .m4b like the ones convert_audiobook makes, generated once per length and re-used
+def generate_audiobook(hours):
+    title = BENCH_TITLE.lower().replace(" ", "_")
+    title_m4b_path = os.path.join(get_title_dir_path(), f"{title}.m4b")
+    marker_path = f"{title_m4b_path}.hours"
+    if os.path.exists(title_m4b_path) and os.path.exists(marker_path):
+        with open(marker_path) as f:
+            if float(f.read()) == hours:
+                return title_m4b_path
+
+    os.makedirs(get_title_dir_path(), exist_ok=True)
+    print(f"Generating a {hours} hour audiobook, this only happens once per length...")
+    subprocess.run([
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=44100:duration={int(hours * 3600)}",
+        "-ac", "2", "-c:a", "aac", "-b:a", "64k", title_m4b_path
+    ], check=True)
+    with open(marker_path, "w") as f:
+        f.write(str(hours))
+    return title_m4b_path
+
+
+# Sidecar records as the sidecar endpoint returns them: bookmarks, clips with an end position and notes on some of
+# them, spread randomly over the book so neighbouring windows overlap as often as real dense bookmarks do
+def generate_records(hours, bookmarks_per_hour, note_ratio, seed):
+    rng = random.Random(seed)
+    length_ms = int(hours * 3600 * 1000)
+    records = []
+    for index in range(int(hours * bookmarks_per_hour)):
+        start_pos = rng.randrange(15000, length_ms - 60000)
+        if rng.random() < 0.5:
+            records.append({"type": "audible.bookmark", "startPosition": str(start_pos)})
+        else:
+            records.append({"type": "audible.clip", "startPosition": str(start_pos),
+                            "endPosition": str(start_pos + rng.randrange(5000, 45000))})
+        if rng.random() < note_ratio:
+            records.append({"type": "audible.note", "startPosition": str(start_pos), "text": f"note {index}"})
+    return records
+
+
+def reset_book_output():
+    title_dir_path = get_title_dir_path()
+    for name in ["clips", "trancribed_clips", "bookmarks.json"]:
+        path = os.path.join(title_dir_path, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+# Runs function once, returns its wall time, Python peak memory (tracemalloc) and whatever it reports back
+def measure(function):
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    try:
+        extra = function() or {}
+        seconds = time.perf_counter() - started_at
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(seconds, 3), "peak_mb": round(peak / (1024 * 1024), 2), **extra}
+
+
+def run_benchmarks(args):
+    api = AudibleAPI(None)
+    title_dir_path = get_title_dir_path()
+    title = BENCH_TITLE.lower().replace(" ", "_")
+    book = {"asin": "BENCHMARK", "title": {"title": BENCH_TITLE, "authors": [{"name": "Benchmark"}]}}
+    records = generate_records(args.hours, args.bookmarks_per_hour, args.note_ratio, args.seed)
+    print(f"{len(records)} sidecar records")
+
+    def extract(mode, merge, clip_format_name):
+        def run():
+            reset_book_output()
+            api.extract_bookmarks(records, title_dir_path, BENCH_TITLE, title, mode, args.workers, merge,
+                                  get_clip_format(clip_format_name))
+            clips_dir_path = os.path.join(title_dir_path, "clips")
+            return {"files": len(os.listdir(clips_dir_path)),
+                    "clip_mb": round(get_dir_size(clips_dir_path) / (1024 * 1024), 2)}
+        return run
+
+    def transcribe():
+        transcriber = StubTranscriber()
+        asyncio.run(api.transcribe_book(book, transcriber, force=True))
+        with open(os.path.join(title_dir_path, "trancribed_clips", "contents.json")) as f:
+            return {"highlights": len(json.load(f))}
+
+    def report():
+        api.write_transcriptions_report()
+        return {"xlsx_kb": round(os.path.getsize(
+            os.path.join(artifacts_root_directory, "audiobooks", "All_Transcriptions.xlsx")) / 1024, 1)}
+
+    benchmarks = [
+        ("extract_seek_original", extract("seek", False, "original")),
+        ("extract_seek_asr", extract("seek", False, "asr")),
+        ("extract_seek_opus", extract("seek", False, "opus")),
+    ]
+    if args.decode:
+        benchmarks.append(("extract_decode_original", extract("decode", False, "original")))
+    # The merged run goes last so the transcription benchmarks work on spans as well as single clips
+    benchmarks += [
+        ("extract_seek_merged", extract("seek", True, "original")),
+        ("transcribe_stub", transcribe),
+        ("report_xlsx", report),
+    ]
+
+    results = {}
+    for name, function in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(function)
+        print(f"{name}: {results[name]}")
+
+    # Peak resident memory of the whole run, ffmpeg processes included
+    results["process"] = {
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children_max_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    }
+    return results
+
+
+def get_settings(args):
+    return {
+        "hours": args.hours, "bookmarks_per_hour": args.bookmarks_per_hour, "note_ratio": args.note_ratio,
+        "seed": args.seed, "workers": args.workers, "cpu_count": os.cpu_count(), "python": platform.python_version()
+    }
+
+
+# Prints every benchmark next to its baseline, returns False when one of them regressed past the tolerance
+def compare(results, baseline, tolerance):
+    if baseline["settings"] != results["settings"]:
+        print(f"Warning: baseline was recorded with {baseline['settings']}, this run used {results['settings']}")
+
+    passed = True
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None or name == "process":
+            continue
+        for key, min_delta in MIN_DELTAS.items():
+            if not base.get(key):
+                continue
+            ratio = result[key] / base[key]
+            regressed = ratio > 1 + tolerance and result[key] - base[key] > min_delta
+            passed = passed and not regressed
+            print(f"{name} {key}: {base[key]} -> {result[key]} ({ratio:.2f}x){'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks clip extraction, encoding and transcription output")
+    parser.add_argument("--hours", type=float, default=3)
+    parser.add_argument("--bookmarks_per_hour", type=float, default=60)
+    parser.add_argument("--note_ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--decode", action="store_true", help="also benchmark --mode=decode, loads the whole book")
+    parser.add_argument("--only", nargs="*", help="names of the benchmarks to run")
+    parser.add_argument("--workdir", default=WORK_DIR, help="where the synthetic book and outputs go")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare the results against the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    generate_audiobook(args.hours)
+    results = {"settings": get_settings(args), "benchmarks": run_benchmarks(args)}
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"No baseline at {args.baseline}, run with --save first")
+            sys.exit(1)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
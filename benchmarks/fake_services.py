@@ -0,0 +1,320 @@
+# Local stand-ins for every service the app talks to, for load testing concurrency and retries without network:
+# the Audible API (library pages, book infos), the download redirect and the AAX CDN (Range requests), the sidecar
+# endpoint, Readwise, Notion and the OpenAI transcription endpoint. Latency, rate limiting (429 with Retry-After) and
+# dropped connections can be injected into every response.
+#
+#   python benchmarks/fake_services.py --titles=10000 --aax_mb=500 --latency=0.05 --error_rate=0.05 --drop_rate=0.01
+#
+# prints the environment variables (see constants.py) that point the app at the fakes. For Audible, use FakeAuth in
+# place of the stored credentials, e.g. AudibleAPI(FakeAuth()). In a test, FakeServices(...).start() does the same
+# in-process and stop() shuts it down. GET /stats returns how many requests every service got and what was injected
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+from audible.localization import Locale
+
+# Bodies are made of this block repeated, so a multi GB AAX costs no memory
+BODY_BLOCK_SIZE = 1024 * 1024
+FIRST_PURCHASE = datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+
+# Stands in for audible.Authenticator, requests go out unsigned and the activation bytes are made up
+class FakeAuth(httpx.Auth):
+
+    def __init__(self, country_code="us"):
+        self.locale = Locale(country_code)
+
+    def get_activation_bytes(self, *args, **kwargs):
+        return "deadbeef"
+
+
+def get_asin(index):
+    return f"B{index:09d}"
+
+
+def get_item(index):
+    return {
+        "asin": get_asin(index),
+        "title": f"Fake Book {index}",
+        "authors": [{"name": f"Fake Author {index % 100}"}],
+        "purchase_date": (FIRST_PURCHASE + timedelta(hours=index)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "runtime_length_min": 600
+    }
+
+
+# The same records for an ASIN on every request, a bookmark every ~10 minutes of a 10 hour book
+def get_records(asin, bookmarks):
+    rng = random.Random(asin)
+    records = []
+    for index in range(bookmarks):
+        start_pos = rng.randrange(15000, 10 * 3600 * 1000)
+        records.append({"type": "audible.bookmark", "startPosition": str(start_pos)})
+        if index % 10 == 0:
+            records.append({"type": "audible.note", "startPosition": str(start_pos), "text": f"note {index}"})
+    return records
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def services(self):
+        return self.server.services
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get("content-length") or 0)) if method == "POST" else b""
+
+        routes = [
+            ("GET", r"/stats", self.send_stats),
+            ("GET", r"/audible/1\.0/library", self.send_library),
+            ("GET", r"/audible/1\.0/library/(\w+)", self.send_book_infos),
+            ("GET", r"/download/library/download", self.send_download_redirect),
+            ("GET", r"/cdn/(\w+)\.aax", self.send_aax),
+            ("GET", r"/sidecar", self.send_sidecar),
+            ("POST", r"/readwise/highlights/?", self.send_readwise),
+            ("POST", r"/notion/pages", self.send_notion),
+            ("POST", r"/openai/audio/transcriptions", self.send_transcription),
+        ]
+        for route_method, pattern, send in routes:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                service = url.path.strip("/").split("/")[0]
+                self.services.count(service)
+                if service != "stats" and not self.inject_faults(service):
+                    return
+                send(query, body, *match.groups())
+                return
+        self.send_json({"error": "not found"}, 404)
+
+    # Sleeps for the latency and answers some requests with a 429 or drops them. False when the request was answered
+    def inject_faults(self, service):
+        services = self.services
+        if services.latency:
+            time.sleep(services.latency * services.random(0.5, 1.5))
+        if services.chance(services.error_rate):
+            services.count(f"{service}_429")
+            self.send_json({"error": "rate limited"}, 429, {"Retry-After": str(services.retry_after)})
+            return False
+        if services.chance(services.drop_rate):
+            services.count(f"{service}_dropped")
+            self.drop_connection()
+            return False
+        return True
+
+    def drop_connection(self):
+        self.close_connection = True
+        try:
+            self.connection.shutdown(2)
+        except OSError:
+            pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stats(self, query, body):
+        self.send_json(self.services.get_stats())
+
+    def send_library(self, query, body):
+        indexes = range(self.services.titles - 1, -1, -1)  # newest purchase first, like the API
+        if query.get("purchased_after"):
+            purchased_after = datetime.strptime(query["purchased_after"], "%Y-%m-%dT%H:%M:%S.000Z").replace(
+                tzinfo=timezone.utc)
+            indexes = [index for index in indexes if FIRST_PURCHASE + timedelta(hours=index) > purchased_after]
+        num_results = int(query.get("num_results", 50))
+        page = int(query.get("page", 1))
+        items = [get_item(index) for index in list(indexes)[(page - 1) * num_results:page * num_results]]
+        self.send_json({"items": items}, headers={"Total-Count": str(len(indexes))})
+
+    def send_book_infos(self, query, body, asin):
+        self.send_json({"item": get_item(int(asin[1:]))})
+
+    def send_download_redirect(self, query, body):
+        self.send_response(302)
+        self.send_header("Location", f"{self.services.url}/cdn/{query.get('asin')}.aax")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # Streams aax_size bytes with Range support, drop_rate also cuts bodies off half way
+    def send_aax(self, query, body, asin):
+        size = self.services.aax_size
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "audio/vnd.audible.aax")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        cut_at = None
+        if self.services.chance(self.services.drop_rate):
+            cut_at = start + (end - start + 1) // 2
+            self.services.count("cdn_cut")
+        position = start
+        block = self.services.block
+        while position <= end:
+            length = min(BODY_BLOCK_SIZE - position % BODY_BLOCK_SIZE, end - position + 1)
+            if cut_at is not None and position + length > cut_at:
+                self.drop_connection()
+                return
+            offset = position % BODY_BLOCK_SIZE
+            try:
+                self.wfile.write(block[offset:offset + length])
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            position += length
+            self.services.count("cdn_bytes", length)
+
+    def send_sidecar(self, query, body):
+        self.send_json({"payload": {"records": get_records(query.get("key", ""), self.services.bookmarks)}})
+
+    def send_readwise(self, query, body):
+        highlights = json.loads(body or b"{}").get("highlights", [])
+        self.services.count("readwise_highlights", len(highlights))
+        self.send_json([])
+
+    def send_notion(self, query, body):
+        self.send_json({"object": "page", "id": f"{random.getrandbits(64):016x}"})
+
+    # Multipart upload of the clip, answers whisper-1's verbose_json with word timestamps too
+    def send_transcription(self, query, body):
+        words = "the quick brown fox jumps over the lazy dog".split()
+        if b"verbose_json" in body:
+            self.send_json({
+                "text": " ".join(words), "duration": 9.0,
+                "words": [{"word": word, "start": index, "end": index + 1} for index, word in enumerate(words)]
+            })
+        else:
+            self.send_json({"text": " ".join(words)})
+
+
+# All fakes behind one threaded HTTP server, each under its own path prefix
+class FakeServices:
+
+    def __init__(self, host="127.0.0.1", port=0, titles=1000, aax_mb=16, bookmarks=60, latency=0, error_rate=0,
+                 drop_rate=0, retry_after=1, seed=None):
+        self.titles = int(titles)
+        self.aax_size = int(float(aax_mb) * 1024 * 1024)
+        self.bookmarks = int(bookmarks)
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.drop_rate = float(drop_rate)
+        self.retry_after = retry_after
+        self.block = bytes(range(256)) * (BODY_BLOCK_SIZE // 256)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.server = ThreadingHTTPServer((host, int(port)), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.services = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    # Environment variables of constants.py that point the app at the fakes
+    def get_environment(self):
+        return {
+            "AUDIBLE_API_URL": f"{self.url}/audible",
+            "AUDIBLE_DOWNLOAD_URL": f"{self.url}/download",
+            "AUDIBLE_SIDECAR_URL": f"{self.url}/sidecar",
+            "READWISE_API_URL": f"{self.url}/readwise",
+            "NOTION_API_URL": f"{self.url}/notion",
+            "OPENAI_BASE_URL": f"{self.url}/openai",
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.rng.random() < rate
+
+    def random(self, low, high):
+        with self.lock:
+            return self.rng.uniform(low, high)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs local stand-ins for Audible, the CDN, Readwise and OpenAI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8470)
+    parser.add_argument("--titles", type=int, default=10000, help="books in the library")
+    parser.add_argument("--aax_mb", type=float, default=64, help="size of every AAX download")
+    parser.add_argument("--bookmarks", type=int, default=60, help="bookmarks per book")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--error_rate", type=float, default=0, help="share of requests answered with a 429")
+    parser.add_argument("--drop_rate", type=float, default=0, help="share of connections dropped")
+    parser.add_argument("--retry_after", default="1", help="Retry-After of the 429s")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    services = FakeServices(args.host, args.port, args.titles, args.aax_mb, args.bookmarks, args.latency,
+                            args.error_rate, args.drop_rate, args.retry_after, args.seed)
+    for key, value in services.get_environment().items():
+        print(f"export {key}={value}")
+    print(f"Serving on {services.url}, stats at {services.url}/stats, Ctrl-C to stop")
+    try:
+        services.server.serve_forever()
+    except KeyboardInterrupt:
+        services.stop()
+
+
+if __name__ == "__main__":
+    main()
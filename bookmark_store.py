@@ -0,0 +1,255 @@
+import os
+import json
+import hashlib
+
+from transcription import Transcript
+
+# Extension of clips that don't say otherwise, clips from older versions are all .flac
+CLIP_EXTENSION = ".flac"
+CLIP_EXTENSIONS = [".flac", ".ogg", ".wav"]
+# Merged windows are saved as __span1.flac, __span2.flac... next to the clips
+SPAN_PREFIX = "__span"
+
+
+# Identifies a sidecar record across runs, notes are part of the key of the clip they name
+def get_record_key(record_type, start_pos, end_pos, text=None):
+    text_hash = hashlib.sha1((text or "").encode()).hexdigest()[:12]
+    return f"{record_type}|{start_pos}|{end_pos}|{text_hash}"
+
+
+# Per book record (audiobooks/<title>/bookmarks.json) of the sidecar records we turned into clips and the
+# transcriptions we got for them, so re-runs only extract and transcribe what is new.
+# A clip either has its own audio file or, when overlapping windows were merged, lives at an offset in a span file
+class BookmarkStore:
+
+    def __init__(self, title_dir_path):
+        self.path = os.path.join(title_dir_path, "bookmarks.json")
+        self.clips_dir_path = os.path.join(title_dir_path, "clips")
+        # file name -> {"key", "start", "end", "extracted", "transcribed", "text", "span", "offset", "extension"},
+        # in bookmark order
+        self.clips = {}
+        # span name -> {"start", "end", "extracted", "transcribed", "text", "words", "extension"}
+        self.spans = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.clips = data.get("clips", {})
+            self.spans = data.get("spans", {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.clips = {}
+            self.spans = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"clips": self.clips, "spans": self.spans}, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def get_clip_path(self, file_name):
+        audio = self.clips.get(file_name) or self.spans.get(file_name) or {}
+        return os.path.join(self.clips_dir_path, f"{file_name}{audio.get('extension', CLIP_EXTENSION)}")
+
+    # Name of the audio file a clip is in, its own or the span it was merged into
+    def get_audio_name(self, file_name):
+        return self.clips[file_name].get("span") or file_name
+
+    # Takes the windows from get_clip_windows and returns the ones that still have to be extracted. Known records
+    # keep the file name they got the first time, records that are gone from the sidecar are dropped with their clip
+    def sync(self, clip_windows, extension=CLIP_EXTENSION):
+        known_names = {clip["key"]: file_name for file_name, clip in self.clips.items()}
+        current_keys = {key for _, _, _, key in clip_windows}
+
+        for file_name, clip in list(self.clips.items()):
+            if clip["key"] not in current_keys and not clip["key"].startswith("file|"):
+                clip_path = self.get_clip_path(file_name)
+                del self.clips[file_name]
+                if not clip.get("span") and os.path.exists(clip_path):
+                    os.remove(clip_path)
+
+        new_windows = []
+        for file_name, start_pos, end_pos, key in clip_windows:
+            if key in known_names:
+                file_name = known_names[key]
+                clip = self.clips[file_name]
+                if clip["extracted"] and os.path.exists(self.get_clip_path(self.get_audio_name(file_name))):
+                    continue
+            elif self.clips.get(file_name, {}).get("key") == f"file|{file_name}":
+                # A clip cut before the store existed, it becomes the clip of the window it was cut for
+                clip = self.clips[file_name]
+                clip.update({"key": key, "start": start_pos, "end": end_pos, "offset": [0, end_pos - start_pos]})
+                if clip["extracted"] and os.path.exists(self.get_clip_path(file_name)):
+                    continue
+            elif file_name in self.clips:
+                file_name = self.get_free_clip_name()
+
+            self.clips[file_name] = {
+                "key": key, "start": start_pos, "end": end_pos,
+                "extracted": False, "transcribed": False, "text": None,
+                "span": None, "offset": [0, end_pos - start_pos], "extension": extension
+            }
+            new_windows.append((file_name, start_pos, end_pos, key))
+
+        self.remove_unused_spans()
+        return new_windows
+
+    def remove_unused_spans(self):
+        used_spans = {clip.get("span") for clip in self.clips.values()}
+        for span_name in list(self.spans):
+            if span_name not in used_spans:
+                span_path = self.get_clip_path(span_name)
+                del self.spans[span_name]
+                if os.path.exists(span_path):
+                    os.remove(span_path)
+
+    def get_free_clip_name(self):
+        file_counter = len(self.clips) + 1
+        while f"clip{file_counter}" in self.clips:
+            file_counter += 1
+        return f"clip{file_counter}"
+
+    # Groups of overlapping windows (see merge_windows) become one span each, their clips point into it.
+    # Returns the (audio name, start, end) files to extract
+    def add_spans(self, merged_windows, extension=CLIP_EXTENSION):
+        files = []
+        span_counter = 1
+        for span_start, span_end, windows in merged_windows:
+            if len(windows) == 1:
+                file_name, start_pos, end_pos, _ = windows[0]
+                files.append((file_name, start_pos, end_pos))
+                continue
+
+            while f"{SPAN_PREFIX}{span_counter}" in self.spans:
+                span_counter += 1
+            span_name = f"{SPAN_PREFIX}{span_counter}"
+            self.spans[span_name] = {
+                "start": span_start, "end": span_end,
+                "extracted": False, "transcribed": False, "text": None, "words": [], "extension": extension
+            }
+            for file_name, start_pos, end_pos, _ in windows:
+                # A clip cut on its own in an earlier run lives in the span from now on
+                clip_path = self.get_clip_path(file_name)
+                if os.path.exists(clip_path):
+                    os.remove(clip_path)
+                self.clips[file_name]["span"] = span_name
+                self.clips[file_name]["offset"] = [start_pos - span_start, end_pos - span_start]
+            files.append((span_name, span_start, span_end))
+        return files
+
+    # With --merge, a new window that lies inside a span cut in an earlier run points into that span and gets its
+    # part of the span's transcription, nothing is cut or transcribed for it. Returns the windows left to extract
+    def attach_to_spans(self, new_windows):
+        remaining = []
+        for file_name, start_pos, end_pos, key in new_windows:
+            span_name = next((span_name for span_name, span in self.spans.items()
+                              if span["extracted"] and span["start"] <= start_pos and end_pos <= span["end"]), None)
+            if span_name is None:
+                remaining.append((file_name, start_pos, end_pos, key))
+                continue
+
+            span = self.spans[span_name]
+            clip = self.clips[file_name]
+            clip["span"] = span_name
+            clip["offset"] = [start_pos - span["start"], end_pos - span["start"]]
+            clip["extracted"] = True
+            if span["transcribed"]:
+                clip["text"] = Transcript(span["text"], span["words"]).slice(
+                    *clip["offset"], span["end"] - span["start"])
+                clip["transcribed"] = True
+        return remaining
+
+    # With --merge, a new window that partly overlaps a clip or span cut in an earlier run re-opens it, so the
+    # overlapping audio is merged and cut again as one span instead of twice. Returns the new windows and the
+    # windows of the clips that were re-opened
+    def reopen_overlapping(self, new_windows, extension=CLIP_EXTENSION):
+        windows = list(new_windows)
+        reopened = True
+        while reopened:
+            reopened = False
+            for file_name, clip in self.clips.items():
+                if not clip["extracted"] or clip["start"] is None:
+                    continue
+                audio = self.spans[clip["span"]] if clip.get("span") else clip
+                if any(start_pos < audio["end"] and audio["start"] < end_pos for _, start_pos, end_pos, _ in windows):
+                    clip_path = self.get_clip_path(file_name)
+                    if not clip.get("span") and clip["extension"] != extension and os.path.exists(clip_path):
+                        os.remove(clip_path)
+                    clip.update({
+                        "extracted": False, "transcribed": False, "text": None,
+                        "span": None, "offset": [0, clip["end"] - clip["start"]], "extension": extension
+                    })
+                    windows.append((file_name, clip["start"], clip["end"], clip["key"]))
+                    reopened = True
+        self.remove_unused_spans()
+        return windows
+
+    def mark_extracted(self, audio_name):
+        if audio_name in self.spans:
+            self.spans[audio_name]["extracted"] = True
+            for clip in self.clips.values():
+                if clip.get("span") == audio_name:
+                    clip["extracted"] = True
+        else:
+            self.clips[audio_name]["extracted"] = True
+
+    # Clips that were made before the store existed are tracked by their file name
+    def add_untracked_clips(self):
+        if not os.path.exists(self.clips_dir_path):
+            return
+        for filename in sorted(os.listdir(self.clips_dir_path)):
+            file_name, extension = os.path.splitext(filename)
+            if extension in CLIP_EXTENSIONS and file_name not in self.clips \
+                    and not file_name.startswith(SPAN_PREFIX):
+                self.clips[file_name] = {
+                    "key": f"file|{file_name}", "start": None, "end": None,
+                    "extracted": True, "transcribed": False, "text": None,
+                    "span": None, "offset": None, "extension": extension
+                }
+
+    def reset_transcriptions(self):
+        for audio in list(self.clips.values()) + list(self.spans.values()):
+            audio["transcribed"] = False
+
+    # Names of the audio files (clips and spans) that were extracted, in bookmark order
+    def get_extracted(self):
+        audio_names = []
+        for file_name, clip in self.clips.items():
+            audio_name = self.get_audio_name(file_name)
+            audio = self.spans[audio_name] if clip.get("span") else clip
+            if audio["extracted"] and audio_name not in audio_names:
+                audio_names.append(audio_name)
+        return audio_names
+
+    # Extracted audio files that were deleted since, get_bookmarks cuts them again
+    def get_missing(self):
+        return [audio_name for audio_name in self.get_extracted()
+                if not os.path.exists(self.get_clip_path(audio_name))]
+
+    # Audio files (clips and spans) that still need a transcription and are on disk, in bookmark order
+    def get_untranscribed(self):
+        audio_names = []
+        for audio_name in self.get_extracted():
+            audio = self.spans.get(audio_name) or self.clips[audio_name]
+            if not audio["transcribed"] and os.path.exists(self.get_clip_path(audio_name)):
+                audio_names.append(audio_name)
+        return audio_names
+
+    # Stores the Transcript of an audio file, every clip in a span gets the part of it that covers the clip
+    def set_transcription(self, audio_name, transcript):
+        if audio_name not in self.spans:
+            self.clips[audio_name]["text"] = transcript.text
+            self.clips[audio_name]["transcribed"] = bool(transcript.text)
+            return
+
+        span = self.spans[audio_name]
+        span["text"] = transcript.text
+        span["words"] = transcript.words
+        span["transcribed"] = bool(transcript.text)
+        for clip in self.clips.values():
+            if clip.get("span") == audio_name:
+                start, end = clip["offset"]
+                clip["text"] = transcript.slice(start, end, span["end"] - span["start"])
+                clip["transcribed"] = span["transcribed"]
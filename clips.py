@@ -0,0 +1,223 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from pydub import AudioSegment
+
+from bookmark_store import get_record_key
+from conversion import parse_duration
+
+# set in ms, how long before and after the bookmark timestamp we want to slice the audioclips, useful for redundancy
+# i.e to account for the time the user spends to dig up their phone and click bookmark
+# Feel free to vary these, but free Speech Recognition API's have certain limits...
+START_POSITION_OFFSET = 10000
+END_POSITION_OFFSET = 0
+
+# Used when a bookmark has no end position (or a zero length one)
+DEFAULT_CLIP_LENGTH = 30000
+
+# Longest span (ms) overlapping windows are merged into. Google Speech Recognition takes about a minute of audio per
+# request, and OpenAI takes 25 MB, which a minute of "original" stereo flac stays well under
+MAX_SPAN_LENGTH = 60000
+
+# Clip extraction modes for get_bookmarks
+# seek: ffmpeg seeks straight to every bookmark window and only decodes those bytes
+# decode: the whole audiobook is decoded into memory with pydub and sliced (old behaviour)
+EXTRACTION_MODES = ["seek", "decode"]
+# The decode mode holds the book's samples a few times over while it's read and converted to the clip format
+DECODE_MEMORY_FACTOR = 3
+
+# Clip formats for get_bookmarks, a sample_rate/channels of None keeps the ones of the audiobook.
+# The speech recognition backends all work on 16 kHz mono, so "asr" and "opus" clips lose nothing for transcription
+# while being a fraction of the size of "original" ones
+CLIP_FORMATS = {
+    "original": {"codec": "flac", "format": "flac", "extension": ".flac", "sample_rate": None, "channels": None},
+    "asr": {"codec": "flac", "format": "flac", "extension": ".flac", "sample_rate": 16000, "channels": 1,
+            "sample_fmt": "s16"},
+    "opus": {"codec": "libopus", "format": "ogg", "extension": ".ogg", "sample_rate": 16000, "channels": 1,
+             "bitrate": "24k"},
+    "wav": {"codec": "pcm_s16le", "format": "wav", "extension": ".wav", "sample_rate": 16000, "channels": 1},
+}
+DEFAULT_CLIP_FORMAT = "original"
+
+
+# Preset from CLIP_FORMATS with the sample rate and channels optionally overridden
+def get_clip_format(name=DEFAULT_CLIP_FORMAT, sample_rate=None, channels=None):
+    if name not in CLIP_FORMATS:
+        raise ValueError(f"Invalid clip format {name}, choose one of: {', '.join(CLIP_FORMATS)}")
+    clip_format = dict(CLIP_FORMATS[name])
+    if sample_rate:
+        clip_format["sample_rate"] = int(sample_rate)
+    if channels:
+        clip_format["channels"] = int(channels)
+    return clip_format
+
+
+# ffmpeg output arguments for a clip format
+def get_clip_format_args(clip_format):
+    args = ["-c:a", clip_format["codec"]]
+    if clip_format.get("sample_rate"):
+        args += ["-ar", str(clip_format["sample_rate"])]
+    if clip_format.get("channels"):
+        args += ["-ac", str(clip_format["channels"])]
+    if clip_format.get("sample_fmt"):
+        args += ["-sample_fmt", clip_format["sample_fmt"]]
+    if clip_format.get("bitrate"):
+        args += ["-b:a", clip_format["bitrate"]]
+    return args
+
+
+# Turns the sidecar records into (file_name, start_pos, end_pos, key) windows in ms, notes are used as the file name
+# for the clip/bookmark that starts at the same position. key identifies the record for the BookmarkStore
+def get_clip_windows(li_bookmarks):
+    li_clips = sorted(
+        li_bookmarks, key=lambda i: i["type"], reverse=True)
+
+    file_counter = 1
+    notes_dict = {}
+    windows = []
+
+    for audio_clip in li_clips:
+        # Get start position to slice
+        raw_start_pos = int(audio_clip["startPosition"])
+
+        # If we have a note then we save it so we can use it as the title for the bookmark text
+        if audio_clip.get("type", None) in ["audible.note"]:
+            notes_dict[raw_start_pos] = audio_clip.get("text")
+            print(
+                f"CLIP: {notes_dict[raw_start_pos]}  {raw_start_pos}")
+
+        if audio_clip.get("type", None) in ["audible.clip", "audible.bookmark"]:
+            start_pos = raw_start_pos - START_POSITION_OFFSET
+            end_pos = int(audio_clip.get(
+                "endPosition", raw_start_pos + DEFAULT_CLIP_LENGTH)) + END_POSITION_OFFSET
+            if start_pos == end_pos:
+                end_pos += DEFAULT_CLIP_LENGTH
+
+            file_name = notes_dict.get(
+                raw_start_pos, f"clip{file_counter}")
+            key = get_record_key(audio_clip["type"], audio_clip["startPosition"],
+                                 audio_clip.get("endPosition"), notes_dict.get(raw_start_pos))
+            windows.append((file_name, max(start_pos, 0), end_pos, key))
+            file_counter += 1
+
+    return windows
+
+
+# Coalesces overlapping windows into spans so the same audio is only cut and transcribed once.
+# A window that would make its span longer than max_length starts a new one, so a run of dense bookmarks doesn't
+# become a span too long to transcribe. Returns [span_start, span_end, [windows]] ordered by start
+def merge_windows(clip_windows, max_length=MAX_SPAN_LENGTH):
+    spans = []
+    for window in sorted(clip_windows, key=lambda window: window[1]):
+        if spans and window[1] <= spans[-1][1] and max(spans[-1][1], window[2]) - spans[-1][0] <= max_length:
+            spans[-1][1] = max(spans[-1][1], window[2])
+            spans[-1][2].append(window)
+        else:
+            spans.append([window[1], window[2], [window]])
+    return spans
+
+
+# Bytes of the whole book as 16 bit samples, from the duration, sample rate and channels ffmpeg reports for it.
+# None when ffmpeg can't tell
+def get_decoded_size(source_path, input_args=None):
+    result = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", *(input_args or []), "-i", source_path],
+                            capture_output=True)
+    info = result.stderr.decode(errors="replace")
+    duration = parse_duration(info)
+    match = re.search(r"Audio: [^\n]*?, (\d+) Hz, (mono|stereo|(\d+) channels)?", info)
+    if duration is None or match is None:
+        return None
+    channels = {"mono": 1, "stereo": 2}.get(match.group(2), int(match.group(3) or 2))
+    return int(duration * int(match.group(1)) * channels * 2)
+
+
+def ms_to_seconds(ms):
+    return f"{ms / 1000:.3f}"
+
+
+# Cuts a single window out of the audiobook with ffmpeg. -ss is placed before -i so ffmpeg seeks in the
+# container instead of decoding everything up to the bookmark, memory and time only depend on the clip length
+# input_args go in front of -i, e.g. ["-activation_bytes", "..."] to read straight from the .aax
+# Downmixing and resampling to the clip format happen in the same ffmpeg pass that decodes the window
+def extract_clip(source_path, clip_path, start_pos, end_pos, input_args=None, clip_format=None):
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        *(input_args or []),
+        "-ss", ms_to_seconds(start_pos),
+        "-i", source_path,
+        "-t", ms_to_seconds(end_pos - start_pos),
+        "-vn",
+        *get_clip_format_args(clip_format or get_clip_format()),
+        clip_path
+    ]
+    subprocess.run(command, check=True, capture_output=True)
+
+
+# Runs inside a worker process, failures are returned instead of raised so every clip gets reported
+def extract_clip_job(file_name, source_path, clip_path, start_pos, end_pos, input_args=None, clip_format=None):
+    try:
+        extract_clip(source_path, clip_path, start_pos, end_pos, input_args, clip_format)
+    except subprocess.CalledProcessError as e:
+        return file_name, e.stderr.decode(errors="replace").strip()
+    except Exception as e:
+        return file_name, str(e)
+    return file_name, None
+
+
+# Same as extract_clip_job for the decode mode, the parent process slices the book and ships the raw samples over.
+# The book is downmixed and resampled once before slicing (see prepare_audio_book), this only encodes
+def export_clip_job(file_name, raw_data, sample_width, frame_rate, channels, clip_path, clip_format=None):
+    clip_format = clip_format or get_clip_format()
+    try:
+        clip = AudioSegment(data=raw_data, sample_width=sample_width,
+                            frame_rate=frame_rate, channels=channels)
+        clip.export(clip_path, format=clip_format["format"], codec=clip_format["codec"],
+                    bitrate=clip_format.get("bitrate")).close()
+    except Exception as e:
+        return file_name, str(e)
+    return file_name, None
+
+
+# Converts the whole decoded book to the clip format in one go, so the samples of every clip are already right
+def prepare_audio_book(audio_book, clip_format):
+    if clip_format.get("channels"):
+        audio_book = audio_book.set_channels(clip_format["channels"])
+    if clip_format.get("sample_rate"):
+        audio_book = audio_book.set_frame_rate(clip_format["sample_rate"])
+    if clip_format.get("sample_fmt") == "s16":
+        audio_book = audio_book.set_sample_width(2)
+    return audio_book
+
+
+def get_default_workers():
+    return os.cpu_count() or 1
+
+
+# Fans the clip jobs out over a process pool. Only a couple of jobs per worker are queued at a time so the decode
+# mode doesn't pickle every clip up front, results are reported in the original bookmark order
+def run_clip_jobs(job, li_job_args, workers=None):
+    workers = max(int(workers or get_default_workers()), 1)
+    results = {}
+    pending = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for order, job_args in enumerate(li_job_args):
+            pending[executor.submit(job, *job_args)] = order
+
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+
+        for future in list(pending):
+            results[pending.pop(future)] = future.result()
+
+    failed = []
+    for order in sorted(results):
+        file_name, error = results[order]
+        if error:
+            print(f"Error while extracting clip {file_name}: {error}")
+            failed.append(file_name)
+    return failed
@@ -2,6 +2,12 @@ from audible_api import AudibleAPI
 from constants import artifacts_root_directory
 from readwise import Readwise
 from openai_config import OpenAIConfig
+from notion import NotionExporter
+from metrics import metrics
+from profiling import Profiler, memory_watchdog
+from utils import str_to_bool
+import os
+import asyncio
 from typing import Optional
 import audible
 
@@ -9,16 +15,40 @@ help_dict = {
     "authenticate": "Logs in to Audible and stores credentials locally to be re-used",
     "openai_authenticate": "Stores OpenAI API key locally to use Whisper (optional)",
     "readwise_authenticate": "Logs in to Readwise and stores token locally",
-    "readwise_post_highlights": "Posts selected highlights to Readwise",
+    "notion_authenticate": "Stores a Notion integration token and the id of the database to export highlights to",
+    "notion_post_highlights": "Exports selected highlights to Notion as one page per highlight, highlights that were already exported are skipped (--force=true exports them again)",
+    "readwise_post_highlights": "Posts selected highlights to Readwise, books whose highlights didn't change are skipped (--force=true posts them again)",
     "list_books": "Lists the users books",
-    "download_books": "Downloads books and saves them locally",
-    "convert_audiobook": "Removes Audible DRM from the selected audiobooks and converts them to .mp3 so they can be sliced",
-    "get_bookmarks": "WIP, extracts all timestamps for bookmarks in the selected audiobook",
-    "transcribe_bookmarks": "Transcribes bookmarks; uses OpenAI Whisper if configured, otherwise Google Speech Recognition (no API key required)",
-    "quit/exit": "Exits this application"
+    "sync_library": "Refreshes the local library snapshot with the books purchased since the last sync, --full=true re-downloads all of it",
+    "download_books": "Downloads books and saves them locally, --concurrency=N sets how many books download at the same time, interrupted downloads resume and finished ones are skipped (--verify=true re-hashes them, --force=true downloads them again), --segments=N splits each book over N connections",
+    "convert_audiobook": "Removes Audible DRM from the selected audiobooks (.m4b), add --mp3=true to also convert them to .mp3, --jobs=N converts N books at once (defaults to the number of cores), --force=true converts books again",
+    "get_bookmarks": "WIP, extracts all timestamps for bookmarks in the selected audiobook and slices them into clips (--mode=seek only decodes the bookmarked windows, --mode=decode loads the whole book, --workers=N encodes clips on N cores, --merge=true cuts overlapping bookmarks once as a shared span, --clip_format=original|asr|opus|wav picks the clip encoding, --sample_rate and --channels override it, --force=true extracts books again)",
+    "transcribe_bookmarks": "Transcribes bookmarks; uses OpenAI Whisper if configured, otherwise Google Speech Recognition (no API key required). --concurrency=N clips at once, --rpm=N caps requests per minute, --cache_size_mb=N sizes the transcription cache, --backend=local transcribes offline on the CPU (needs transformers and torch), --pack=N sends N clips per request, --force=true transcribes books again",
+    "sync": "Downloads, converts, extracts bookmarks, transcribes and posts to Readwise and Notion (when set up) the selected books in one go, the stages of different books run at the same time (--queue_size=N books wait between stages, takes the options of the single commands, --convert_jobs is the --jobs of convert_audiobook, --transcribe_concurrency is the --concurrency of transcribe_bookmarks, --force=true runs stages that were already done again)",
+    "show_jobs": "Shows which stages every book went through, with their status and how long they took",
+    "show_metrics": "Shows where the last command spent its time per stage (library fetch, metadata, download, ffmpeg, sidecar, clip slicing, transcription, export), every stage run is also written as a JSON line under the artifacts directory",
+    "quit/exit": "Exits this application",
+    "--profile": "Add to any command to profile it, the CPU profile and a report of the top allocations are written to the profiles directory under the artifacts directory",
+    "--memory_budget_mb": "Add to any command to keep it under N MB of memory, from 80% of it the decode mode of get_bookmarks falls back to seek, past it the command is stopped"
 }
 
-AUTHLESS_COMMANDS = ["help", "quit", "exit", "authenticate", "readwise_authenticate", "openai_authenticate"]
+AUTHLESS_COMMANDS = ["help", "quit", "exit", "authenticate", "readwise_authenticate", "openai_authenticate",
+                     "notion_authenticate"]
+
+
+# "--mp3=true --jobs=4" -> {"mp3": "true", "jobs": "4"}, a bare flag (--force) is the same as --force=true.
+# None when there is something that isn't an option
+def parse_kwargs(additional_kwargs):
+    _kwargs = {}
+    li_kwargs = f" {additional_kwargs.strip()}".split(" --")
+    if li_kwargs[0].strip():
+        return None
+    for kwarg in li_kwargs[1:]:
+        key, separator, value = kwarg.strip().partition("=")
+        if not key:
+            return None
+        _kwargs[key] = value if separator else "true"
+    return _kwargs
 
 class Command:
         
@@ -26,7 +56,17 @@ class Command:
       self.audible_obj: Optional[AudibleAPI] = None
       self.readwise_obj: Optional[Readwise] = None
       self.openai_obj: Optional[OpenAIConfig] = None  
+      self.notion_obj: Optional[NotionExporter] = None
   
+  # Closes the pooled HTTP clients
+  async def close(self):
+      if self.audible_obj:
+          await self.audible_obj.close()
+      if self.readwise_obj:
+          await self.readwise_obj.close()
+      if self.notion_obj:
+          await self.notion_obj.close()
+
   def show_help(self):
       for key in help_dict:
         print(f"{key} -- {help_dict[key]}")
@@ -56,29 +96,63 @@ class Command:
         print("\nNo OpenAI API Key found, please run 'openai_authenticate' to add it (if you would like to use OpenAI Whisper for transcribing the bookmarks). Otherwise, we'll use Google Speech Recognition (no API key required)")
         api_key = None
     
+    # Notion is optional, the settings can also come from the NOTION_TOKEN and NOTION_DATABASE_ID variables
+    try:
+      self.notion_obj = NotionExporter.from_file(f"{artifacts_root_directory}/secrets/notion.json")
+    except FileNotFoundError:
+      if os.environ.get("NOTION_TOKEN") and os.environ.get("NOTION_DATABASE_ID"):
+        self.notion_obj = NotionExporter(os.environ["NOTION_TOKEN"], os.environ["NOTION_DATABASE_ID"])
+
     print("Audible Bookmark Extractor v1.0")
     print("To download your audiobooks, ensure you are authenticated, then enter download_books")
     print("Enter help for a list of commands")
     
   async def command_loop(self):
     command_input = input("\n\nEnter command: ")
-    command = command_input.split(" ")[0]
-    additional_kwargs = command_input.replace(command, '')
-    _kwargs = {}
-
-    if additional_kwargs:
-        for kwarg in additional_kwargs.split(" --"):
-            if kwarg == "":
-                continue
-            li_kwarg = kwarg.split("=")
-
-            if not len(li_kwarg) > 1:
-                await self.invalid_kwarg_callback()
+    command, _, additional_kwargs = command_input.strip().partition(" ")
+    _kwargs = parse_kwargs(additional_kwargs)
 
-            _kwargs[li_kwarg[0]] = li_kwarg[1]
+    if _kwargs is None:
+        await self.invalid_kwarg_callback()
+        return await self.command_loop()
 
     if not self.audible_obj and command not in AUTHLESS_COMMANDS:
         await self.invalid_auth_callback()
+        return await self.command_loop()
+    # Every stage the command goes through is recorded under one run in the metrics (see metrics.py)
+    metrics.start_run(command)
+    try:
+        await self.run_profiled(command, _kwargs)
+    finally:
+        metrics.finish_run()
+    if command == "quit" or command == "exit":
+        return
+
+    await self.command_loop()
+
+  # --profile and --memory_budget_mb work with any command, they are taken out before the command gets its options
+  async def run_profiled(self, command, _kwargs):
+    profiler = Profiler(command) if str_to_bool(_kwargs.pop("profile", "false")) else None
+    memory_budget_mb = _kwargs.pop("memory_budget_mb", None)
+
+    # The command runs as its own task, so going over the memory budget can cancel it without leaving the loop
+    task = asyncio.ensure_future(self.run_command(command, _kwargs))
+    if memory_budget_mb:
+        memory_watchdog.start(memory_budget_mb, asyncio.get_running_loop(), task)
+    if profiler:
+        profiler.start()
+    try:
+        await task
+    except asyncio.CancelledError:
+        if not memory_watchdog.exceeded:
+            raise
+        print(f"\n{command} was stopped for going over the {memory_budget_mb} MB memory budget")
+    finally:
+        if profiler:
+            profiler.stop()
+        memory_watchdog.stop()
+
+  async def run_command(self, command, _kwargs):
     # Takes the command supplied and sees if we have a function with the prefix cmd_ that we can execute with the given kwargs
     if command == "help":
       self.show_help()
@@ -88,24 +162,35 @@ class Command:
         self.readwise_obj = await Readwise.authenticate()
     elif command == "openai_authenticate":
         self.openai_obj = await OpenAIConfig.authenticate()
+    elif command == "notion_authenticate":
+        self.notion_obj = await NotionExporter.authenticate()
     elif command == "quit" or command == "exit":
       return
     elif command.startswith("readwise"):
         books = await self.audible_obj.get_book_selection()
         command = command.replace("readwise_", "")
         await getattr(self.readwise_obj, f"cmd_{command}", self.invalid_command_callback)(books, **_kwargs)    
+    elif command.startswith("notion"):
+        if not self.notion_obj:
+            print("You are not authenticated with Notion. Use the Command notion_authenticate first")
+        else:
+            books = await self.audible_obj.get_book_selection()
+            command = command.replace("notion_", "")
+            await getattr(self.notion_obj, f"cmd_{command}", self.invalid_command_callback)(books, **_kwargs)
     else:    
         # Pass openai_obj to methods that might need it
         method = getattr(self.audible_obj, f"cmd_{command}", self.invalid_command_callback)
         if command == "transcribe_bookmarks" and self.openai_obj:
             await method(openai_api_key=self.openai_obj.api_key, **_kwargs)
+        elif command == "sync":
+            await method(readwise=self.readwise_obj, notion=self.notion_obj,
+                         openai_api_key=self.openai_obj.api_key if self.openai_obj else None, **_kwargs)
         else:
             await method(**_kwargs)
-    
-    await self.command_loop()
   
   # Callbacks
-  async def invalid_command_callback(self):
+  # Stands in for any cmd_ method, so it takes whatever the command would have been called with
+  async def invalid_command_callback(self, *args, **kwargs):
       print("Invalid command, try again")      
 
   async def invalid_kwarg_callback(self):
@@ -1,3 +1,20 @@
 import os
 
-artifacts_root_directory = os.path.join(os.path.expanduser("~"), "audible-bookmark-extractor")
\ No newline at end of file
+artifacts_root_directory = os.environ.get(
+    "AUDIBLE_ARTIFACTS_DIR", os.path.join(os.path.expanduser("~"), "audible-bookmark-extractor"))
+
+# Where the services we talk to live. Each one can be pointed somewhere else with an environment variable, e.g. at
+# the local stand-ins of benchmarks/fake_services.py for load testing without network
+# None keeps the Audible API and store of the account's marketplace
+AUDIBLE_API_URL = os.environ.get("AUDIBLE_API_URL")
+AUDIBLE_DOWNLOAD_URL = os.environ.get("AUDIBLE_DOWNLOAD_URL")
+AUDIBLE_SIDECAR_URL = os.environ.get(
+    "AUDIBLE_SIDECAR_URL", "https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar")
+READWISE_API_URL = os.environ.get("READWISE_API_URL", "https://readwise.io/api/v2")
+NOTION_API_URL = os.environ.get("NOTION_API_URL", "https://api.notion.com/v1")
+# None keeps the OpenAI default (which also reads OPENAI_BASE_URL itself)
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+
+# Prometheus textfile the stage metrics are also written to (see metrics.py), e.g. into node_exporter's
+# --collector.textfile.directory. None only writes the JSON lines under the artifacts directory
+METRICS_TEXTFILE = os.environ.get("AUDIBLE_METRICS_TEXTFILE")
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import re
+import sys
+
+from metrics import metrics
+
+# ffmpeg lines kept for the error message when a job fails
+STDERR_TAIL_LINES = 20
+
+
+def get_default_jobs():
+    return os.cpu_count() or 1
+
+
+# "Duration: 01:02:03.45" -> seconds
+def parse_duration(line):
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+# ffmpeg writes to a temporary file next to the output, so an interrupted job never leaves a truncated file behind
+# that looks converted. The extension stays last so ffmpeg still picks the container from it
+def get_temp_path(path):
+    root, extension = os.path.splitext(path)
+    return f"{root}.part{extension}"
+
+
+# Runs ffmpeg jobs as child processes, up to `jobs` of them at the same time (defaults to the number of cores, every
+# job is one ffmpeg process that mostly keeps one core busy). Progress is read from ffmpeg's -progress output and
+# shown for all running jobs on one line, a cancelled job (Ctrl-C) terminates its ffmpeg and removes its output
+class ConversionScheduler:
+
+    def __init__(self, jobs=None):
+        self.jobs = max(int(jobs or get_default_jobs()), 1)
+        self.semaphore = asyncio.Semaphore(self.jobs)
+        # label -> [seconds converted, duration in seconds or None]
+        self.progress = {}
+
+    # Converts to output_path with the given ffmpeg arguments (everything but the output), returns True on success
+    async def run(self, label, args, output_path):
+        async with self.semaphore:
+            with metrics.stage("ffmpeg", book=label) as span:
+                passed = await self.run_process(label, args, output_path)
+                if passed:
+                    span.add(bytes=os.path.getsize(output_path))
+                else:
+                    span.status = "error"
+                return passed
+
+    # One ffmpeg process, the caller holds its slot of the scheduler
+    async def run_process(self, label, args, output_path):
+        temp_path = get_temp_path(output_path)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-y", "-progress", "pipe:1",
+                *args, temp_path,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError as e:
+            # Mostly ffmpeg not being installed, see the readme
+            print(f"\nCould not run ffmpeg for {label}: {e}")
+            return False
+        self.progress[label] = [0, None]
+        stderr_tail = []
+        try:
+            await asyncio.gather(
+                self.read_progress(process.stdout, label),
+                self.read_stderr(process.stderr, label, stderr_tail)
+            )
+            returncode = await process.wait()
+        except BaseException:
+            await self.stop(process)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            self.progress.pop(label, None)
+
+        if returncode != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            print(f"\nffmpeg failed for {label} with exit code {returncode}")
+            print("\n".join(stderr_tail))
+            return False
+
+        os.replace(temp_path, output_path)
+        print(f"\nConverted {label}")
+        return True
+
+    # -progress writes blocks of key=value lines ending in a progress= line, out_time_us is how far into the input
+    # ffmpeg got (older versions only write out_time_ms, which is in microseconds as well)
+    async def read_progress(self, stream, label):
+        async for line in stream:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            if key in ["out_time_us", "out_time_ms"] and value.isdigit():
+                self.progress[label][0] = int(value) / 1000000
+            elif key == "progress":
+                self.show_progress()
+
+    async def read_stderr(self, stream, label, stderr_tail):
+        async for line in stream:
+            line = line.decode(errors="replace").rstrip()
+            if self.progress[label][1] is None:
+                self.progress[label][1] = parse_duration(line)
+            stderr_tail.append(line)
+            del stderr_tail[:-STDERR_TAIL_LINES]
+
+    @staticmethod
+    async def stop(process):
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    # Single progress bar over every running job that reported a duration
+    def show_progress(self):
+        sized = [value for value in self.progress.values() if value[1]]
+        if not sized:
+            return
+
+        done_seconds = sum(min(value[0], value[1]) for value in sized)
+        total_seconds = sum(value[1] for value in sized)
+        done = int(50 * done_seconds / total_seconds)
+        sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)))
+        sys.stdout.write(f"   {int(done_seconds / total_seconds * 100)}%  ({len(self.progress)} converting)")
+        sys.stdout.flush()
@@ -0,0 +1,269 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sys
+
+import httpx
+
+from metrics import metrics
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+# Books smaller than this are never split into segments, the extra requests aren't worth it
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_part_path(path):
+    return f"{path}.part"
+
+
+# Stores the expected size and, once finished, the sha256 of a download next to it
+def get_manifest_path(path):
+    return f"{path}.manifest.json"
+
+
+def read_manifest(path):
+    try:
+        with open(get_manifest_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(path, manifest):
+    with open(get_manifest_path(path), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+
+def get_file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+# True when path was fully downloaded before, verify_hash also re-hashes the file against the manifest
+def is_download_complete(path, verify_hash=False):
+    manifest = read_manifest(path)
+    if not manifest.get("complete") or not os.path.exists(path):
+        return False
+    if os.path.getsize(path) != manifest.get("size"):
+        return False
+    if verify_hash and get_file_sha256(path) != manifest.get("sha256"):
+        return False
+    return True
+
+
+# "bytes 100-199/1000" or "bytes */1000" -> 1000
+def parse_content_range_total(content_range):
+    match = re.search(r"/(\d+)$", content_range or "")
+    return int(match.group(1)) if match else None
+
+
+# Downloads several books at once over a single pooled httpx client. At most `concurrency` bodies are streamed
+# at the same time and the file writes are pushed to a thread so the event loop keeps serving the other downloads
+class Downloader:
+
+    # segments > 1 splits every book into that many byte ranges which are fetched over parallel connections
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, segments=1):
+        self.concurrency = max(int(concurrency), 1)
+        self.segments = max(int(segments), 1)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0, read=120.0),
+            limits=httpx.Limits(max_connections=self.concurrency * self.segments,
+                                max_keepalive_connections=self.concurrency * self.segments)
+        )
+        # label -> [bytes downloaded, total bytes or None]
+        self.progress = {}
+        # label -> [[segment bytes downloaded, segment size], ...] for segmented downloads
+        self.segment_progress = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    # Streams url into path, returns True when the whole body was written and verified
+    async def download(self, url, path, label):
+        async with self.semaphore:
+            try:
+                with metrics.stage("download", book=label, segments=self.segments) as span:
+                    # An unfinished segmented download has to be continued as one, whatever mode we are in now
+                    if self.segments > 1 or read_manifest(path).get("segments"):
+                        downloaded = await self.download_segmented(url, path, label)
+                    else:
+                        downloaded = await self.stream_to_file(url, path, label)
+                    if not downloaded:
+                        span.status = "error"
+                    return downloaded
+            except httpx.HTTPError as e:
+                print(f"\nError while downloading {label}: {e}")
+                return False
+            finally:
+                self.progress.pop(label, None)
+                self.segment_progress.pop(label, None)
+
+    # Data goes to a .part file first, when one is left over from an interrupted run we only ask for the missing
+    # bytes with a Range request. The .part is renamed to path once its size matches what the server announced
+    async def stream_to_file(self, url, path, label):
+        part_path = get_part_path(path)
+        manifest = read_manifest(path)
+
+        # A finished file without a manifest comes from an older version, resume from it in case it's truncated
+        if os.path.exists(path) and not is_download_complete(path):
+            os.replace(path, part_path)
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        async with self.client.stream("GET", url, headers=headers) as response:
+            # The .part already holds everything the server has
+            if response.status_code == 416:
+                total_length = parse_content_range_total(response.headers.get("content-range")) or manifest.get("size")
+                if total_length != offset:
+                    os.remove(part_path)
+                    print(f"\nPartial download of {label} doesn't match the server, starting over")
+                    return await self.stream_to_file(url, path, label)
+                return await self.finish_download(path, total_length, label)
+
+            if not response.is_success:
+                print(f"\nError while downloading {label}: {response.status_code}")
+                print((await response.aread()).decode(errors="replace"))
+                return False
+
+            total_length = None
+            if response.status_code == 206:
+                total_length = parse_content_range_total(response.headers.get("content-range"))
+                print(f"\nResuming {label} from {offset} bytes")
+            else:
+                # Server ignored the Range header, start from byte zero
+                offset = 0
+                if response.headers.get("content-length"):
+                    total_length = int(response.headers["content-length"])
+                print(f"\nDownloading {label}")
+
+            if total_length is None:  # no content length header
+                print(
+                    "Unable to estimate download size, downloading, this might take a while...")
+            else:
+                write_manifest(path, {"size": total_length, "complete": False})
+
+            self.progress[label] = [offset, total_length]
+            with open(part_path, "ab" if offset else "wb") as f:
+                async for data in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, data)
+                    self.progress[label][0] += len(data)
+                    metrics.add(bytes=len(data))
+                    self.show_progress()
+
+            return await self.finish_download(path, total_length, label)
+
+    # Checks the .part against the expected size, hashes it and moves it into place
+    async def finish_download(self, path, total_length, label):
+        part_path = get_part_path(path)
+        size = os.path.getsize(part_path)
+        if total_length is not None and size != total_length:
+            print(f"\nDownload of {label} is incomplete ({size} of {total_length} bytes), run download_books again to resume")
+            return False
+
+        sha256 = await asyncio.to_thread(get_file_sha256, part_path)
+        os.replace(part_path, path)
+        write_manifest(path, {"size": size, "sha256": sha256, "complete": True})
+        print(f"\nFinished downloading {label}")
+        return True
+
+    # Splits the book into byte ranges that are fetched in parallel and written at their offset in a preallocated
+    # .part file. How far each segment got is kept in the manifest so an interrupted run resumes every segment
+    async def download_segmented(self, url, path, label):
+        part_path = get_part_path(path)
+        manifest = read_manifest(path)
+
+        if not (manifest.get("segments") and os.path.exists(part_path)):
+            total_length = await self.get_content_length(url)
+            if total_length is None or total_length < MIN_SEGMENT_SIZE:
+                # No Range support or too small to be worth splitting
+                return await self.stream_to_file(url, path, label)
+
+            segment_size = -(-total_length // self.segments)
+            manifest = {"size": total_length, "complete": False, "segments": [
+                [start, min(start + segment_size, total_length) - 1, 0]
+                for start in range(0, total_length, segment_size)
+            ]}
+            with open(part_path, "wb") as f:
+                f.truncate(total_length)
+            write_manifest(path, manifest)
+            print(f"\nDownloading {label} in {len(manifest['segments'])} segments")
+        else:
+            print(f"\nResuming {label} in {len(manifest['segments'])} segments")
+
+        total_length = manifest["size"]
+        self.progress[label] = [sum(segment[2] for segment in manifest["segments"]), total_length]
+        self.segment_progress[label] = [[segment[2], segment[1] - segment[0] + 1] for segment in manifest["segments"]]
+
+        results = await asyncio.gather(*[
+            self.download_segment(url, path, label, manifest, index) for index in range(len(manifest["segments"]))
+        ], return_exceptions=True)
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f"\nError while downloading segment {index} of {label}: {result}")
+
+        if any(segment[2] != segment[1] - segment[0] + 1 for segment in manifest["segments"]):
+            print(f"\nDownload of {label} is incomplete, run download_books again to resume")
+            return False
+
+        return await self.finish_download(path, total_length, label)
+
+    async def download_segment(self, url, path, label, manifest, index):
+        start, end, done = manifest["segments"][index]
+        if start + done > end:
+            return
+
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if response.status_code != 206:
+                raise httpx.HTTPStatusError(
+                    f"Segment {index} of {label} failed with {response.status_code}", request=response.request, response=response)
+
+            with open(get_part_path(path), "r+b") as f:
+                f.seek(start + done)
+                async for data in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, data)
+                    manifest["segments"][index][2] += len(data)
+                    self.progress[label][0] += len(data)
+                    self.segment_progress[label][index][0] += len(data)
+                    metrics.add(bytes=len(data))
+                    write_manifest(path, manifest)
+                    self.show_progress()
+
+    # Asks for the first byte only to learn the full size, None when the server doesn't do Range requests
+    async def get_content_length(self, url):
+        async with self.client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+            if response.status_code != 206:
+                return None
+            return parse_content_range_total(response.headers.get("content-range"))
+
+    # Single progress bar over every download that reported a size
+    def show_progress(self):
+        sized = [value for value in self.progress.values() if value[1]]
+        if not sized:
+            return
+
+        dl = sum(value[0] for value in sized)
+        total_length = sum(value[1] for value in sized)
+        done = int(50 * dl / total_length)
+        sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)))
+        sys.stdout.write(f"   {int(dl / total_length * 100)}%  ({len(self.progress)} downloading)")
+        # Per segment percentages of the segmented downloads
+        for segments in self.segment_progress.values():
+            sys.stdout.write(" [%s]" % " ".join(f"{int(done / size * 100)}%" for done, size in segments))
+        sys.stdout.flush()
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from constants import artifacts_root_directory
+
+# In the order a book goes through them
+STAGES = ["download", "convert", "get_bookmarks", "transcribe", "readwise", "notion"]
+
+
+# Fingerprint of whatever a stage's result depends on, a stage is only skipped while it stays the same
+def get_fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# Size and modification time, cheap to get even for a whole audiobook
+def get_file_fingerprint(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+# Per book and stage record of what was done, with which inputs and how long it took, so re-runs skip the stages a
+# book already went through and retry the ones that failed. Kept in a SQLite database under the artifacts directory.
+# Stages of different books run in threads as well as on the event loop, so every query goes through one lock
+class JobStore:
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(artifacts_root_directory, "jobs.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "asin TEXT NOT NULL, stage TEXT NOT NULL, title TEXT, status TEXT NOT NULL, fingerprint TEXT, "
+            "started_at REAL, finished_at REAL, error TEXT, PRIMARY KEY (asin, stage))"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, asin, stage):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT title, status, fingerprint, started_at, finished_at, error FROM jobs "
+                "WHERE asin = ? AND stage = ?", (asin, stage)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["title", "status", "fingerprint", "started_at", "finished_at", "error"], row))
+
+    def get_all(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT asin, stage, title, status, started_at, finished_at, error FROM jobs "
+                "ORDER BY title, asin").fetchall()
+        return [dict(zip(["asin", "stage", "title", "status", "started_at", "finished_at", "error"], row))
+                for row in rows]
+
+    # Done with the same inputs and the outputs are still there
+    def is_done(self, asin, stage, fingerprint, outputs=()):
+        job = self.get(asin, stage)
+        if job is None or job["status"] != "done" or job["fingerprint"] != fingerprint:
+            return False
+        return all(os.path.exists(path) for path in outputs)
+
+    def start(self, asin, stage, title, fingerprint):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs (asin, stage, title, status, fingerprint, started_at, finished_at, error) "
+                "VALUES (?, ?, ?, 'running', ?, ?, NULL, NULL)", (asin, stage, title, fingerprint, time.time()))
+            self.connection.commit()
+
+    def finish(self, asin, stage, passed, error=None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE asin = ? AND stage = ?",
+                ("done" if passed else "failed", time.time(), error, asin, stage))
+            self.connection.commit()
+
+    # Awaits function() unless the stage is already done for these inputs, returns True when the book can go on
+    async def run(self, asin, stage, title, fingerprint, function, outputs=(), force=False):
+        if not force and self.is_done(asin, stage, fingerprint, outputs):
+            print(f"{stage} already done for {title}, skipping")
+            return True
+
+        self.start(asin, stage, title, fingerprint)
+        try:
+            passed = await function()
+        except BaseException as e:
+            self.finish(asin, stage, False, str(e) or type(e).__name__)
+            raise
+        self.finish(asin, stage, passed)
+        return passed
+
+    # Same as run, for the stages that block
+    def run_sync(self, asin, stage, title, fingerprint, function, outputs=(), force=False):
+        if not force and self.is_done(asin, stage, fingerprint, outputs):
+            print(f"{stage} already done for {title}, skipping")
+            return True
+
+        self.start(asin, stage, title, fingerprint)
+        try:
+            passed = function()
+        except BaseException as e:
+            self.finish(asin, stage, False, str(e) or type(e).__name__)
+            raise
+        self.finish(asin, stage, passed)
+        return passed
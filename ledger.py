@@ -0,0 +1,48 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from constants import artifacts_root_directory
+
+
+# Identifies a highlight by what ends up in the export, so an edited transcription counts as a new highlight
+def get_highlight_hash(highlight):
+    content = {key: highlight.get(key) for key in ["title", "author", "text", "note"]}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+# Hashes of the highlights that were exported, per destination (readwise, notion), so every run only sends the
+# highlights that are new since the last one
+class HighlightLedger:
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(artifacts_root_directory, "ledger.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS posted ("
+            "destination TEXT NOT NULL, hash TEXT NOT NULL, posted_at REAL NOT NULL, "
+            "PRIMARY KEY (destination, hash))"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    # The highlights that weren't exported to destination yet
+    def get_new(self, destination, highlights):
+        with self.lock:
+            posted = {row[0] for row in self.connection.execute(
+                "SELECT hash FROM posted WHERE destination = ?", (destination,))}
+        return [highlight for highlight in highlights if get_highlight_hash(highlight) not in posted]
+
+    def add(self, destination, highlights):
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO posted (destination, hash, posted_at) VALUES (?, ?, ?)",
+                [(destination, get_highlight_hash(highlight), time.time()) for highlight in highlights])
+            self.connection.commit()
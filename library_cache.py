@@ -0,0 +1,57 @@
+import os
+import json
+from datetime import datetime, timedelta, timezone
+
+from constants import artifacts_root_directory
+
+# The library endpoint doesn't return more than this per page
+LIBRARY_PAGE_SIZE = 1000
+# Snapshots older than this are topped up with the books purchased since the last sync
+LIBRARY_MAX_AGE = timedelta(hours=24)
+# Purchases can take a while to show up, so incremental syncs look back a bit further than the last sync
+LIBRARY_SYNC_MARGIN = timedelta(days=2)
+
+
+def format_timestamp(timestamp):
+    return timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def parse_timestamp(timestamp):
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc)
+
+
+# Snapshot of the users library saved under the artifacts directory, so listing and selecting books works
+# without going to the Audible API every session
+class LibraryCache:
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(artifacts_root_directory, "library.json")
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def save(self, items, synced_at):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"synced_at": format_timestamp(synced_at), "items": items}, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def is_stale(snapshot, now):
+        return now - parse_timestamp(snapshot["synced_at"]) > LIBRARY_MAX_AGE
+
+    # Parameter for the incremental sync, everything purchased since the last sync (minus the margin)
+    @staticmethod
+    def get_purchased_after(snapshot):
+        return format_timestamp(parse_timestamp(snapshot["synced_at"]) - LIBRARY_SYNC_MARGIN)
+
+    # New and updated items replace the cached ones and go to the top, like the API orders them (newest first)
+    @staticmethod
+    def merge(cached_items, new_items):
+        new_asins = {item["asin"] for item in new_items}
+        return new_items + [item for item in cached_items if item["asin"] not in new_asins]
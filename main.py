@@ -8,6 +8,8 @@ async def main():
         await cmd.command_loop()
     except KeyboardInterrupt:
         print("\nExiting...")
+    finally:
+        await cmd.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,48 @@
+import os
+import json
+import time
+
+from constants import artifacts_root_directory
+
+# How long item metadata from library/{asin} is trusted before asking Audible again, in seconds
+METADATA_TTL = 7 * 24 * 60 * 60
+
+
+def split_response_groups(response_groups):
+    return sorted({group.strip() for group in response_groups.split(",") if group.strip()})
+
+
+# One json file per ASIN with the last response we got and the response groups it was requested with. A cached
+# response is only used while it is fresh and was fetched with (at least) the response groups asked for now
+class MetadataCache:
+
+    def __init__(self, directory=None, ttl=METADATA_TTL):
+        self.directory = directory or os.path.join(artifacts_root_directory, "cache", "metadata")
+        self.ttl = ttl
+
+    def get_path(self, asin):
+        return os.path.join(self.directory, f"{asin}.json")
+
+    def get(self, asin, response_groups):
+        try:
+            with open(self.get_path(asin)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if time.time() - entry.get("fetched_at", 0) > self.ttl:
+            return None
+        if not set(split_response_groups(response_groups)) <= set(entry.get("response_groups", [])):
+            return None
+        return entry["book"]
+
+    def set(self, asin, response_groups, book):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.get_path(asin)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "fetched_at": time.time(),
+                "response_groups": split_response_groups(response_groups),
+                "book": book
+            }, f)
+        os.replace(tmp_path, self.get_path(asin))
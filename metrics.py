@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from constants import artifacts_root_directory, METRICS_TEXTFILE
+
+# The Prometheus textfile is rewritten at most this often while a command runs, and once when it's done
+TEXTFILE_INTERVAL = 10
+
+# Span of the stage the running code is in, asyncio tasks and to_thread calls started inside a stage inherit it
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+# One run of a stage, counts are whatever the stage reports: bytes, items, retries, cache_hits...
+class Span:
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.counts = {}
+        self.status = "ok"
+        self.error = None
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + value
+
+    def get_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+# Records how long every stage of a command took and what it moved, as JSON lines in
+# artifacts/metrics/metrics.jsonl (one line per stage run and one per command) and, when METRICS_TEXTFILE is set, as
+# Prometheus counters per stage. Stages run on the event loop and in threads, so every update goes through one lock
+class Metrics:
+
+    def __init__(self, path=None, textfile=METRICS_TEXTFILE):
+        self.path = path or os.path.join(artifacts_root_directory, "metrics", "metrics.jsonl")
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.command = None
+        self.run_started_at = None
+        # stage -> {"runs", "errors", "seconds", counts...}, for the running command and since the process started
+        self.run_totals = {}
+        self.totals = {}
+        # (name, labels) -> [last value, highest value]
+        self.gauges = {}
+        self.textfile_written_at = 0
+
+    def start_run(self, command):
+        with self.lock:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.command = command
+            self.run_started_at = time.time()
+            self.run_totals = {}
+
+    # Writes the command's totals, nothing when it didn't go through any stage
+    def finish_run(self):
+        with self.lock:
+            run_totals = self.run_totals
+            self.run_totals = {}
+        if run_totals:
+            self.write({"type": "run", "seconds": round(time.time() - self.run_started_at, 3), "stages": run_totals})
+            self.write_textfile()
+
+    # with metrics.stage("download", book=title) as span: ... span.add(bytes=n) or metrics.add(bytes=n) anywhere below
+    @contextmanager
+    def stage(self, name, **labels):
+        span = Span(name, labels)
+        token = current_span.set(span)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            span.status = "cancelled"
+            raise
+        except BaseException as e:
+            span.status = "error"
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            current_span.reset(token)
+            self.record(span, time.perf_counter() - started_at)
+
+    # Adds to the counts of the innermost stage we are in, counts outside of any stage are dropped
+    def add(self, **counts):
+        span = current_span.get()
+        if span is not None:
+            span.add(**counts)
+
+    # Samples a level, e.g. how many books wait in front of a pipeline stage
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            gauge = self.gauges.setdefault((name, tuple(sorted(labels.items()))), [value, value])
+            gauge[0] = value
+            gauge[1] = max(gauge[1], value)
+        self.write({"type": "gauge", "name": name, "labels": labels, "value": value})
+
+    def record(self, span, seconds):
+        counts = span.get_counts()
+        with self.lock:
+            for totals in [self.run_totals, self.totals]:
+                stage = totals.setdefault(span.stage, {"runs": 0, "errors": 0, "seconds": 0})
+                stage["runs"] += 1
+                stage["errors"] += span.status == "error"
+                stage["seconds"] = round(stage["seconds"] + seconds, 3)
+                for key, value in counts.items():
+                    stage[key] = stage.get(key, 0) + value
+
+        self.write({
+            "type": "stage", "stage": span.stage, "labels": span.labels, "started_at": round(span.started_at, 3),
+            "seconds": round(seconds, 3), "status": span.status, "error": span.error, "counts": counts
+        })
+        if self.textfile and time.time() - self.textfile_written_at >= TEXTFILE_INTERVAL:
+            self.write_textfile()
+
+    def write(self, record):
+        record = {"time": round(time.time(), 3), "run": self.run_id, "command": self.command, **record}
+        line = json.dumps(record, default=str)
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    # Totals of the last command that went through a stage, None when nothing was recorded yet
+    def get_last_run(self):
+        last_run = None
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if '"type": "run"' in line:
+                        last_run = line
+        except FileNotFoundError:
+            return None
+        return json.loads(last_run) if last_run else None
+
+    # Counters since the process started, written to a temporary file first so the collector never reads half of it
+    def write_textfile(self):
+        if not self.textfile:
+            return
+        with self.lock:
+            totals = {stage: dict(values) for stage, values in self.totals.items()}
+            gauges = {key: list(values) for key, values in self.gauges.items()}
+            self.textfile_written_at = time.time()
+
+        lines = []
+        counters = sorted({key for values in totals.values() for key in values})
+        for counter in counters:
+            metric = f"audible_stage_{counter}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for stage, values in sorted(totals.items()):
+                if counter in values:
+                    lines.append(f'{metric}{{stage="{stage}"}} {values[counter]}')
+        for name in sorted({name for name, _ in gauges}):
+            for suffix, index in [("", 0), ("_max", 1)]:
+                metric = f"audible_{name}{suffix}"
+                lines.append(f"# TYPE {metric} gauge")
+                for (gauge_name, labels), values in sorted(gauges.items()):
+                    if gauge_name == name:
+                        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                        lines.append(f"{metric}{{{label_text}}} {values[index]}")
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.textfile)), exist_ok=True)
+        temp_path = f"{self.textfile}.tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.textfile)
+
+
+# Shared by every module, so the stages of one command all end up in the same run
+metrics = Metrics()
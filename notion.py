@@ -1,44 +1,177 @@
-import requests
 import os
-from datetime import datetime
+import json
+import asyncio
 
+import httpx
+
+from constants import artifacts_root_directory, NOTION_API_URL
+from jobs import JobStore, get_fingerprint
+from ledger import HighlightLedger
+from metrics import metrics
+from ratelimit import RateLimiter, send_with_retries
+from utils import str_to_bool
+
+NOTION_PAGES_URL = f"{NOTION_API_URL}/pages"
+NOTION_VERSION = "2022-02-22"
+# Notion allows an average of 3 requests per second per integration, pages are created by this many workers paced
+# to that budget
+NOTION_REQUESTS_PER_MINUTE = 180
+NOTION_CONCURRENCY = 3
+NOTION_QUEUE_SIZE = 100
+# Longest text a single rich text object may hold
+NOTION_TEXT_LIMIT = 2000
+
+
+# Long transcriptions are split over several rich text objects
+def get_rich_text(content):
+    content = content or ""
+    return [{"text": {"content": content[i:i + NOTION_TEXT_LIMIT]}}
+            for i in range(0, max(len(content), 1), NOTION_TEXT_LIMIT)]
+
+
+# Creates a page per highlight in a Notion database with a "Heading" title and a "Content" text property.
+# Highlights of all books go through one queue, worked off by NOTION_CONCURRENCY workers over a pooled client
 class NotionExporter:
-    def post_notion(text_heading, text_content):
-        token = os.environ.get("NOTION_TOKEN")
-        url = "https://api.notion.com/v1/pages"
 
+    def __init__(self, token, database_id):
+        self.token = token
+        self.database_id = database_id
+        self.jobs = JobStore()
+        self.ledger = HighlightLedger()
+        self.rate_limiter = RateLimiter(NOTION_REQUESTS_PER_MINUTE)
+        self.queue = None
+        self.workers = []
+        self._client = None
+
+    @classmethod
+    async def authenticate(self) -> "NotionExporter":
+        notion_path = os.path.join(artifacts_root_directory, "secrets", "notion.json")
+        if os.path.exists(notion_path):
+            print(f"You are already authenticated with Notion, to switch, delete the file at {notion_path} and try again")
+            return NotionExporter.from_file(notion_path)
+
+        token = input("Notion integration token (Go to https://www.notion.so/my-integrations to get one): ").strip()
+        database_id = input("Id of the Notion database to add the highlights to: ").strip()
+
+        os.makedirs(os.path.dirname(notion_path), exist_ok=True)
+        with open(notion_path, "w") as f:
+            json.dump({"token": token, "database_id": database_id}, f)
+        print("Notion settings saved locally successfully")
+
+        return NotionExporter(token, database_id)
+
+    @classmethod
+    def from_file(self, notion_path):
+        with open(notion_path) as f:
+            settings = json.load(f)
+        return NotionExporter(settings["token"], settings["database_id"])
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "Accept": "application/json",
+                    "Notion-Version": NOTION_VERSION
+                },
+                timeout=httpx.Timeout(30.0),
+                limits=httpx.Limits(max_connections=NOTION_CONCURRENCY, max_keepalive_connections=NOTION_CONCURRENCY)
+            )
+        return self._client
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # Highlights that were already exported are skipped, --force=true exports them again
+    async def cmd_post_highlights(self, books, force="false"):
+        try:
+            await asyncio.gather(*[self.post_book_highlights(book, str_to_bool(force)) for book in books])
+        finally:
+            await self.close()
+
+    # Queues the new highlights of a book's contents.json, returns False when some of them couldn't be exported
+    async def post_book_highlights(self, book, force=False):
+        _title = book.get("title", {}).get("title", 'untitled')
+        title = _title.lower().replace(" ", "_")
+
+        with open(os.path.join(artifacts_root_directory, "audiobooks", title, "trancribed_clips", "contents.json")) as f:
+            highlights = json.load(f)
+
+        return await self.jobs.run(book.get("asin"), "notion", _title, get_fingerprint(highlights),
+                                   lambda: self.post_highlights(_title, highlights, force), force=force)
+
+    # Every highlight is a queue entry with a future the workers resolve, so the highlights of several books
+    # share the workers and the request budget
+    async def post_highlights(self, _title, highlights, force=False):
+        if not force:
+            highlights = self.ledger.get_new("notion", highlights)
+        if not highlights:
+            print(f"No new highlights to export to Notion for {_title}")
+            return True
+
+        print(f"Exporting {len(highlights)} highlights of {_title} to Notion…")
+        self.start_workers()
+        futures = []
+        for highlight in highlights:
+            future = asyncio.get_running_loop().create_future()
+            futures.append(future)
+            await self.queue.put((highlight, future))
+            metrics.gauge("queue_depth", self.queue.qsize(), stage="notion_export")
+        results = await asyncio.gather(*futures)
+
+        if not all(results):
+            print(f"Exported {results.count(True)} of {len(highlights)} highlights of {_title}, "
+                  f"run notion_post_highlights again to retry")
+            return False
+        print(f"Highlights of {_title} exported to Notion successfully")
+        return True
+
+    def start_workers(self):
+        if self.workers:
+            return
+        self.queue = asyncio.Queue(NOTION_QUEUE_SIZE)
+        self.workers = [asyncio.create_task(self.run_worker()) for _ in range(NOTION_CONCURRENCY)]
+
+    async def run_worker(self):
+        while True:
+            highlight, future = await self.queue.get()
+            try:
+                exported = await self.post_highlight(highlight)
+            except Exception as e:
+                # Keep the worker alive, a dead one would leave the futures of the highlights behind it unresolved
+                print(f"Error while exporting to Notion: {e}")
+                exported = False
+            if not future.done():
+                future.set_result(exported)
+
+    async def post_highlight(self, highlight):
         data = {
-            "parent": {"database_id": "1b9cbc3855e942e6b6ecf9bc0bde3a49"},
+            "parent": {"database_id": self.database_id},
             "properties": {
                 "Heading": {
-                    "title": [
-                        {
-                            "text": {
-                                "content": text_heading
-                            }
-                        }
-                    ]
+                    "title": get_rich_text(highlight.get("note") or highlight.get("title"))
                 },
                 "Content": {
-                    "rich_text": [
-                        {
-                            "text": {
-                                "content": text_content
-                            }
-                        }
-                    ]
+                    "rich_text": get_rich_text(highlight.get("text"))
                 }
             }}
-        import json
-        data = json.dumps(data)
-
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/json",
-            "Notion-Version": "2022-02-22",
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(url, headers=headers, data=data)
 
-        print(response.text)
+        with metrics.stage("notion_export") as span:
+            response = await send_with_retries(self.client, "POST", NOTION_PAGES_URL,
+                                               rate_limiter=self.rate_limiter, json=data)
+            if not response.is_success:
+                print(f"Error: {response.status_code}")
+                print(response.text)
+                span.status = "error"
+                return False
+            self.ledger.add("notion", [highlight])
+            span.add(items=1, bytes=len(response.request.content))
+            return True
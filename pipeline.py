@@ -0,0 +1,87 @@
+import asyncio
+
+from metrics import metrics
+
+# How many books can wait between two stages, keeps a fast stage from running far ahead of a slow one
+DEFAULT_QUEUE_SIZE = 2
+
+# Put on a queue after the last book
+STOP = None
+
+
+# A stage of the pipeline, function is awaited with a book and returns True when the book can go on to the next stage
+class Stage:
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(int(workers), 1)
+
+
+# Streams books through stages, each one with its own workers, connected by bounded queues. While book N is in the
+# last stage, book N+1 can be in the one before it and so on, so a run over many books takes about as long as its
+# slowest stage instead of the sum of all of them. A book that fails a stage doesn't go on to the next one
+class Pipeline:
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE, get_label=str):
+        self.stages = stages
+        self.queue_size = max(int(queue_size), 1)
+        self.get_label = get_label
+        # label -> name of the stage the book failed in
+        self.failed = {}
+        self.finished = []
+
+    async def run(self, books):
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        tasks = [asyncio.create_task(self.feed(books, queues[0]))]
+        for index, stage in enumerate(self.stages):
+            out_queue = queues[index + 1] if index + 1 < len(queues) else None
+            tasks.append(asyncio.create_task(self.run_stage(stage, queues[index], out_queue)))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Ctrl-C or an unexpected error in one stage stops all of them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self.finished
+
+    async def feed(self, books, queue):
+        for book in books:
+            await queue.put(book)
+        await queue.put(STOP)
+
+    async def run_stage(self, stage, in_queue, out_queue):
+        await asyncio.gather(*[self.run_worker(stage, in_queue, out_queue) for _ in range(stage.workers)])
+        if out_queue is not None:
+            await out_queue.put(STOP)
+
+    async def run_worker(self, stage, in_queue, out_queue):
+        while True:
+            book = await in_queue.get()
+            if book is STOP:
+                # Leave it for the other workers of this stage
+                await in_queue.put(STOP)
+                return
+
+            # Books piling up in front of a stage show it's the one holding the others back
+            metrics.gauge("queue_depth", in_queue.qsize(), stage=stage.name)
+            label = self.get_label(book)
+            try:
+                passed = await stage.function(book)
+            except Exception as e:
+                print(f"\n{stage.name} failed for {label}: {e}")
+                passed = False
+
+            if not passed:
+                self.failed[label] = stage.name
+            elif out_queue is not None:
+                await out_queue.put(book)
+            else:
+                self.finished.append(book)
+
+    def report(self):
+        print(f"\n{len(self.finished)} books went through all stages")
+        for label, stage_name in self.failed.items():
+            print(f"{label} stopped at {stage_name}")
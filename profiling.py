@@ -0,0 +1,194 @@
+import io
+import os
+import gc
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+import _thread
+from datetime import datetime
+
+from constants import artifacts_root_directory
+
+# How often the memory is looked at while a command runs
+SAMPLE_INTERVAL = 0.5
+# Frames kept per allocation, enough to see which caller of a library function allocated
+TRACEMALLOC_FRAMES = 10
+# Lines in the CPU and allocation reports
+REPORT_LIMIT = 30
+# A new allocation snapshot is only taken once the traced peak grew by this much since the last one
+SNAPSHOT_GROWTH = 1.1
+# Share of the memory budget from which the watchdog frees what it can and the stages that can go lighter do
+SOFT_LIMIT = 0.8
+# How long a cancelled command gets to wind down before the whole program is interrupted
+ABORT_GRACE_SECONDS = 10
+
+
+# Resident memory of this process right now, the peak so far where /proc isn't available, None where neither is
+# (Windows)
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return get_peak_rss()
+
+
+# Highest resident memory of this process so far, None where the resource module doesn't exist (Windows)
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# CPU profile (cProfile) and allocation tracking (tracemalloc) of one command. The CPU profile covers the event loop
+# thread, work handed to threads or the clip process pool shows up there as time spent waiting. Allocations are
+# tracked in every thread, with a snapshot of the top allocations whenever the traced peak grows, so the report shows
+# what was alive at the peak and not only what is left at the end. Everything goes to artifacts/profiles/
+class Profiler:
+
+    def __init__(self, command):
+        self.command = command
+        started_at = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.base_path = os.path.join(artifacts_root_directory, "profiles", f"{command}_{started_at}")
+        self.profile = cProfile.Profile()
+        self.peak_snapshot = None
+        self.peak_snapshot_size = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.thread = threading.Thread(target=self.watch_peak, daemon=True)
+        self.thread.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.stopped.set()
+        self.thread.join()
+        _, peak = tracemalloc.get_traced_memory()
+        end_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        os.makedirs(os.path.dirname(self.base_path), exist_ok=True)
+        self.profile.dump_stats(f"{self.base_path}.prof")
+        with open(f"{self.base_path}_cpu.txt", "w") as f:
+            f.write(self.get_cpu_report())
+        with open(f"{self.base_path}_memory.txt", "w") as f:
+            f.write(self.get_memory_report(peak, end_snapshot))
+        print(f"\nProfile of {self.command} written to {self.base_path}.prof (open it with pstats or snakeviz), "
+              f"{self.base_path}_cpu.txt and {self.base_path}_memory.txt")
+
+    def watch_peak(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            _, peak = tracemalloc.get_traced_memory()
+            if peak > self.peak_snapshot_size * SNAPSHOT_GROWTH:
+                self.peak_snapshot = tracemalloc.take_snapshot()
+                self.peak_snapshot_size = peak
+
+    def get_cpu_report(self):
+        output = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=output).strip_dirs()
+        output.write(f"{self.command}, by cumulative time\n")
+        stats.sort_stats("cumulative").print_stats(REPORT_LIMIT)
+        output.write(f"\n{self.command}, by own time\n")
+        stats.sort_stats("tottime").print_stats(REPORT_LIMIT)
+        return output.getvalue()
+
+    def get_memory_report(self, peak, end_snapshot):
+        peak_rss = get_peak_rss()
+        peak_rss_text = f"{peak_rss / (1024 * 1024):.1f} MB" if peak_rss is not None else "not available"
+        lines = [
+            f"{self.command}",
+            f"Traced peak: {peak / (1024 * 1024):.1f} MB, peak resident: {peak_rss_text}",
+        ]
+        snapshots = [("around the traced peak", self.peak_snapshot), ("still allocated at the end", end_snapshot)]
+        for name, snapshot in snapshots:
+            if snapshot is None:
+                continue
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            lines.append(f"\nTop allocations {name}, by line")
+            for stat in snapshot.statistics("lineno")[:REPORT_LIMIT]:
+                lines.append(f"  {stat.size / (1024 * 1024):10.2f} MB  {stat.count:8} blocks  {stat.traceback[0]}")
+            lines.append(f"\nBiggest allocations {name}, with where they were made from")
+            for stat in snapshot.statistics("traceback")[:5]:
+                lines.append(f"  {stat.size / (1024 * 1024):.2f} MB in {stat.count} blocks")
+                lines += [f"    {line}" for line in stat.traceback.format(most_recent_first=True)]
+        return "\n".join(lines) + "\n"
+
+
+# Keeps a command under a resident memory budget. Past SOFT_LIMIT of it, garbage is collected once and the stages
+# that have a lighter way of working switch to it (see get_headroom). Past the budget, the command is cancelled, so
+# ffmpeg jobs are stopped and the job database records the failure, and when it doesn't wind down within
+# ABORT_GRACE_SECONDS (blocking code can't be cancelled) the whole program is interrupted like with Ctrl-C twice
+class MemoryWatchdog:
+
+    def __init__(self):
+        self.budget = None
+        self.exceeded = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # The budget applies from now until stop(), task is cancelled when it's exceeded
+    def start(self, budget_mb, loop, task):
+        if get_rss() is None:
+            print("Resident memory can't be read on this system, --memory_budget_mb is ignored")
+            return
+        self.budget = float(budget_mb) * 1024 * 1024
+        self.exceeded = False
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.watch, args=(loop, task), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.budget = None
+        self.exceeded = False
+
+    # Bytes left before the soft limit, None without a budget
+    def get_headroom(self):
+        if self.budget is None:
+            return None
+        return max(self.budget * SOFT_LIMIT - get_rss(), 0)
+
+    def watch(self, loop, task):
+        warned = False
+        cancelled_at = None
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            rss = get_rss()
+            if rss > self.budget * SOFT_LIMIT and not warned:
+                warned = True
+                print(f"\nMemory at {rss / (1024 * 1024):.0f} MB of the {self.budget / (1024 * 1024):.0f} MB budget, "
+                      f"freeing what we can")
+                gc.collect()
+            if rss <= self.budget:
+                continue
+
+            if cancelled_at is None:
+                self.exceeded = True
+                cancelled_at = time.monotonic()
+                print(f"\nMemory at {rss / (1024 * 1024):.0f} MB, over the {self.budget / (1024 * 1024):.0f} MB "
+                      f"budget, stopping the command")
+                loop.call_soon_threadsafe(task.cancel)
+            elif time.monotonic() - cancelled_at > ABORT_GRACE_SECONDS:
+                # asyncio.run takes the first interrupt to cancel its main task, which blocking code on the loop
+                # thread never gets to see, only the second one raises KeyboardInterrupt in whatever is running
+                print("\nThe command didn't stop in time, interrupting")
+                _thread.interrupt_main()
+                if not self.stopped.wait(SAMPLE_INTERVAL):
+                    _thread.interrupt_main()
+                return
+
+
+# Shared, so the stages can ask how much memory they have left
+memory_watchdog = MemoryWatchdog()
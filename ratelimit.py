@@ -0,0 +1,76 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from metrics import metrics
+
+
+# Spaces out request starts so no more than `requests_per_minute` go out, shared by all workers of a backend
+class RateLimiter:
+
+    def __init__(self, requests_per_minute=None):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self.next_request_at = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_request_at - now
+            self.next_request_at = max(now, self.next_request_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Responses worth trying again after a pause
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+# Backoff when the server doesn't say how long to wait, doubled on every attempt
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+
+# Seconds to wait before the next attempt, the Retry-After header (seconds or an HTTP date) when there is one
+def get_retry_delay(response, attempt):
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0), RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max(retry_at.timestamp() - time.time(), 0), RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+    delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# Sends a request on an httpx.AsyncClient, waiting for the rate limiter before every attempt and retrying rate
+# limited (429), failing (5xx) and dropped requests with backoff. Returns the last response, raises the last
+# transport error when not a single attempt got through
+async def send_with_retries(client, method, url, rate_limiter=None, max_retries=MAX_RETRIES, **kwargs):
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            await rate_limiter.wait()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+            metrics.add(retries=1)
+            await asyncio.sleep(get_retry_delay(None, attempt))
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+            return response
+        delay = get_retry_delay(response, attempt)
+        metrics.add(retries=1)
+        print(f"\n{url} answered {response.status_code}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
@@ -1,12 +1,31 @@
 import os
 import json
-from constants import artifacts_root_directory
-import requests
+import asyncio
+from constants import artifacts_root_directory, READWISE_API_URL
+from jobs import JobStore, get_fingerprint
+from ledger import HighlightLedger
+from metrics import metrics
+from ratelimit import RateLimiter, send_with_retries
+from utils import str_to_bool
+import httpx
+
+READWISE_HIGHLIGHTS_URL = f"{READWISE_API_URL}/highlights/"
+# Highlights per request and requests in flight at the same time
+READWISE_BATCH_SIZE = 100
+READWISE_CONCURRENCY = 4
+# Readwise allows 240 requests per minute per token
+READWISE_REQUESTS_PER_MINUTE = 240
+READWISE_FIELD_LIMITS = {"title": 511, "author": 1024, "text": 8191, "note": 8191}
 
 class Readwise:
   
   def __init__(self, token):
     self.token = token
+    self.jobs = JobStore()
+    self.ledger = HighlightLedger()
+    self.semaphore = asyncio.Semaphore(READWISE_CONCURRENCY)
+    self.rate_limiter = RateLimiter(READWISE_REQUESTS_PER_MINUTE)
+    self._client = None
   
   @classmethod
   async def authenticate(self) -> "Readwise":
@@ -21,25 +40,90 @@ class Readwise:
       
       return Readwise(token)
   
-  async def cmd_post_highlights(self, books):
+  # Books whose highlights didn't change since they were posted are skipped, --force=true posts them again
+  async def cmd_post_highlights(self, books, force="false"):
     if not os.path.exists(f"{artifacts_root_directory}/secrets/readwise_token.json"):
       print("You are not authenticated with readwise. Use the Command readwise-authenticate first")
       return
     
-    for book in books:
-      print("Posting to Readwise…")
-      title = book.get("title", {}).get("title", 'untitled')
-      title = title.lower().replace(" ", "_")
-      
-      with open(f"{artifacts_root_directory}/audiobooks/{title}/trancribed_clips/contents.json", "r") as f:
-        highlights = json.load(f)
-      
-      response = requests.post(url="https://readwise.io/api/v2/highlights/", 
-                               headers={"Authorization": f"Token {self.token}"}, 
-                               json={"highlights": highlights})
-
-      if response.status_code != 200:
-          print(f"Error: {response.status_code}")
-          print(response.text)
-      else:
-          print("Highlights posted successfully")
+    try:
+      await asyncio.gather(*[self.post_book_highlights(book, str_to_bool(force)) for book in books])
+    finally:
+      await self.close()
+
+  # One pooled client for all batches of all books
+  @property
+  def client(self):
+    if self._client is None:
+      self._client = httpx.AsyncClient(
+        headers={"Authorization": f"Token {self.token}"},
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_connections=READWISE_CONCURRENCY, max_keepalive_connections=READWISE_CONCURRENCY)
+      )
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  # Posts the contents.json of a book, returns False when Readwise didn't take all of them
+  async def post_book_highlights(self, book, force=False):
+    _title = book.get("title", {}).get("title", 'untitled')
+    title = _title.lower().replace(" ", "_")
+    
+    with open(f"{artifacts_root_directory}/audiobooks/{title}/trancribed_clips/contents.json", "r") as f:
+      highlights = json.load(f)
+
+    return await self.jobs.run(book.get("asin"), "readwise", _title, get_fingerprint(highlights),
+                               lambda: self.post_highlights(_title, highlights, force), force=force)
+
+  # Only the highlights that aren't in the ledger yet are sent, in batches of READWISE_BATCH_SIZE that go out
+  # concurrently. Every batch that got through is added to the ledger right away, so a failed run resumes after it
+  async def post_highlights(self, _title, highlights, force=False):
+    if not force:
+      highlights = self.ledger.get_new("readwise", highlights)
+    if not highlights:
+      print(f"No new highlights to post for {_title}")
+      return True
+
+    print(f"Posting {len(highlights)} highlights of {_title} to Readwise…")
+    batches = [highlights[i:i + READWISE_BATCH_SIZE] for i in range(0, len(highlights), READWISE_BATCH_SIZE)]
+    results = await asyncio.gather(*[self.post_batch(batch) for batch in batches])
+
+    posted = sum(len(batch) for batch, result in zip(batches, results) if result)
+    if posted != len(highlights):
+      print(f"Posted {posted} of {len(highlights)} highlights of {_title}, run readwise_post_highlights again to retry")
+      return False
+    print(f"Highlights of {_title} posted successfully")
+    return True
+
+  async def post_batch(self, batch):
+    with metrics.stage("readwise_export") as span:
+      async with self.semaphore:
+        try:
+          response = await send_with_retries(self.client, "POST", READWISE_HIGHLIGHTS_URL,
+                                             rate_limiter=self.rate_limiter,
+                                             json={"highlights": [fit_highlight(highlight) for highlight in batch]})
+        except httpx.HTTPError as e:
+          print(f"Error while posting to Readwise: {e}")
+          span.status = "error"
+          return False
+
+      if not response.is_success:
+        print(f"Error: {response.status_code}")
+        print(response.text)
+        span.status = "error"
+        return False
+      self.ledger.add("readwise", batch)
+      span.add(items=len(batch), bytes=len(response.request.content))
+      return True
+
+
+# Readwise rejects highlights with fields longer than it allows, long transcriptions are cut to fit
+def fit_highlight(highlight):
+  highlight = dict(highlight)
+  for key, max_length in READWISE_FIELD_LIMITS.items():
+    if isinstance(highlight.get(key), str) and len(highlight[key]) > max_length:
+      highlight[key] = highlight[key][:max_length]
+  return highlight
@@ -0,0 +1,79 @@
+import os
+
+import pandas as pd
+import pandas.io.formats.excel
+
+from bookmark_store import BookmarkStore
+
+INVALID_SHEET_CHARACTERS = "[]:*?/\\"
+
+
+# Excel sheet names are at most 31 characters, can't contain some characters and have to be unique
+def get_sheet_name(title, used_sheet_names):
+    sheet_name = "".join(c for c in title if c not in INVALID_SHEET_CHARACTERS)[:31] or "untitled"
+    suffix = 1
+    while sheet_name.lower() in used_sheet_names:
+        suffix += 1
+        sheet_name = f"{sheet_name[:31 - len(str(suffix)) - 1]}_{suffix}"
+    used_sheet_names.add(sheet_name.lower())
+    return sheet_name
+
+
+# Transcriptions of every book that has a bookmark store, as (title, {clip note: transcription}) in title order
+def get_book_transcriptions(audiobooks_dir_path):
+    books = []
+    if not os.path.exists(audiobooks_dir_path):
+        return books
+
+    for title in sorted(os.listdir(audiobooks_dir_path)):
+        title_dir_path = os.path.join(audiobooks_dir_path, title)
+        if not os.path.exists(os.path.join(title_dir_path, "bookmarks.json")):
+            continue
+        store = BookmarkStore(title_dir_path)
+        pairs = {heading: clip["text"] for heading, clip in store.clips.items() if clip["text"]}
+        if pairs:
+            books.append((title, pairs))
+    return books
+
+
+# Writes the workbook in a single pass, one sheet per book
+def write_transcriptions_workbook(path, books):
+    # Change header format so that rows can be edited
+    pandas.io.formats.excel.ExcelFormatter.header_style = None
+
+    # Create writer instance with desired path
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        workbook = writer.book
+
+        # Create header format to be used in all headers
+        header_format = workbook.add_format({
+            "valign": "vcenter",
+            "align": "center",
+            "bg_color": "#FFA500",
+            "bold": True,
+            "font_color": "#FFFFFF"})
+
+        # Set desired cell format
+        cell_format = workbook.add_format()
+        cell_format.set_align("vcenter")
+        cell_format.set_align("center")
+        cell_format.set_text_wrap(True)
+
+        used_sheet_names = set()
+        for title, pairs in books:
+            xcel = pd.DataFrame(pairs.values(), index=pairs.keys())
+
+            # Create a sheet in the same workbook for each book
+            sheet_name = get_sheet_name(title, used_sheet_names)
+            xcel.to_excel(writer, sheet_name=sheet_name)
+            worksheet = writer.sheets[sheet_name]
+
+            # Apply header format and format columns to fit data
+            worksheet.write(0, 0, 'Clip Note', header_format)
+            worksheet.write(0, 1, 'Transcription', header_format)
+            worksheet.set_column("B:B", 100)
+            worksheet.set_column("A:A", 50)
+
+            # Format cells for appropiate size, wrap the text for style points
+            for i in range(1, (len(xcel)+1)):
+                worksheet.set_row(i, 100, cell_format)
@@ -0,0 +1,346 @@
+import os
+import asyncio
+import subprocess
+import tempfile
+
+import numpy as np
+import speech_recognition as sr
+from openai import AsyncOpenAI
+
+from constants import OPENAI_BASE_URL
+from metrics import metrics
+from ratelimit import RateLimiter
+
+
+TRANSCRIPTION_BACKENDS = ["openai", "google", "local"]
+
+# Whisper models expect 16 kHz mono float samples
+LOCAL_SAMPLE_RATE = 16000
+
+# Local models are loaded once per process and shared by every LocalTranscriber, so they stay loaded across books
+_local_pipelines = {}
+
+
+# Text of a transcribed file, words holds (start, end, word) tuples in seconds when the backend gives us timestamps
+class Transcript:
+
+    def __init__(self, text, words=None):
+        self.text = text
+        self.words = [tuple(word) for word in words or []]
+
+    # Text spoken between start and end (ms from the start of the file). Without timestamps the words are assumed
+    # to be spread evenly over the duration of the file
+    def slice(self, start, end, duration):
+        if self.words:
+            return " ".join(word.strip() for word_start, word_end, word in self.words
+                            if start <= (word_start + word_end) * 500 < end)
+
+        words = self.text.split()
+        if not words or duration <= 0:
+            return self.text
+        first = max(min(int(len(words) * start / duration), len(words) - 1), 0)
+        last = max(-(-len(words) * end // duration), first + 1)
+        return " ".join(words[first:int(last)])
+
+
+# A transcription backend, the pool runs up to `concurrency` transcribe calls at once and the rate limiter keeps
+# them under the backends request budget. Backends that can transcribe several clips in one call set batch_size
+# and override transcribe_batch, the others only implement transcribe. Both return Transcripts.
+# max_pack_seconds and max_pack_bytes are the largest audio file the backend takes in one request, None for no limit
+class Transcriber:
+    name = None
+    model = None
+    concurrency = 4
+    requests_per_minute = None
+    batch_size = 1
+    max_pack_seconds = None
+    max_pack_bytes = None
+
+    def __init__(self, concurrency=None, requests_per_minute=None, batch_size=None):
+        self.concurrency = max(int(concurrency or self.concurrency), 1)
+        self.rate_limiter = RateLimiter(float(requests_per_minute or self.requests_per_minute or 0))
+        self.batch_size = max(int(batch_size or self.batch_size), 1)
+
+    async def transcribe(self, path):
+        raise NotImplementedError
+
+    async def transcribe_batch(self, paths):
+        return [await self.transcribe(path) for path in paths]
+
+    async def close(self):
+        pass
+
+
+class OpenAITranscriber(Transcriber):
+    name = "openai"
+    model = "gpt-4o-transcribe"
+    concurrency = 8
+    requests_per_minute = 500
+    # The API takes files up to 25 MB
+    max_pack_bytes = 24 * 1024 * 1024
+
+    def __init__(self, api_key, model=None, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model or self.model
+        self.client = AsyncOpenAI(api_key=api_key, base_url=OPENAI_BASE_URL)
+
+    async def transcribe(self, path):
+        with open(path, "rb") as audio_file:
+            # Only whisper-1 returns word timestamps, the gpt-4o models return plain text
+            if self.model == "whisper-1":
+                transcription = await self.client.audio.transcriptions.create(
+                    model=self.model,
+                    file=audio_file,
+                    response_format="verbose_json",
+                    timestamp_granularities=["word"]
+                )
+                return Transcript(transcription.text, [
+                    (word.start, word.end, word.word) for word in transcription.words or []])
+
+            transcription = await self.client.audio.transcriptions.create(
+                model=self.model,
+                file=audio_file
+            )
+        return Transcript(transcription.text)
+
+    async def close(self):
+        await self.client.close()
+
+
+# SpeechRecognition is blocking, so every call runs in its own thread
+class GoogleTranscriber(Transcriber):
+    name = "google"
+    concurrency = 4
+    requests_per_minute = 60
+    # The free web API rejects audio much longer than a minute
+    max_pack_seconds = 60
+
+    def recognize(self, path):
+        r = sr.Recognizer()
+        if path.endswith((".wav", ".flac", ".aiff")):
+            audioclip = sr.AudioFile(path)
+            with audioclip as source:
+                audio = r.record(source)
+        else:
+            # SpeechRecognition can't read compressed clips (e.g. opus), hand it the decoded samples instead
+            samples = (np.clip(load_audio(path), -1, 1) * 32767).astype(np.int16)
+            audio = sr.AudioData(samples.tobytes(), LOCAL_SAMPLE_RATE, 2)
+        return r.recognize_google(audio)
+
+    async def transcribe(self, path):
+        return Transcript(await asyncio.to_thread(self.recognize, path))
+
+
+# Offline Whisper on the CPU through the transformers ASR pipeline (pip install transformers torch). A whole batch
+# of clips goes through the model in a single call, which runs in a thread to keep the event loop free
+class LocalTranscriber(Transcriber):
+    name = "local"
+    model = "openai/whisper-base"
+    concurrency = 1
+    batch_size = 16
+
+    def __init__(self, model=None, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model or self.model
+        try:
+            import transformers  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "The local transcription backend needs transformers and torch, install them with: "
+                "pip install transformers torch") from None
+
+    def get_pipeline(self):
+        if self.model not in _local_pipelines:
+            from transformers import pipeline
+            print(f"Loading local transcription model {self.model}")
+            _local_pipelines[self.model] = pipeline(
+                "automatic-speech-recognition", model=self.model, device="cpu")
+        return _local_pipelines[self.model]
+
+    def recognize_batch(self, paths):
+        inputs = [{"raw": load_audio(path), "sampling_rate": LOCAL_SAMPLE_RATE} for path in paths]
+        outputs = self.get_pipeline()(inputs, batch_size=self.batch_size, return_timestamps="word")
+        return [Transcript(output["text"].strip(), [
+            (chunk["timestamp"][0], chunk["timestamp"][1] or chunk["timestamp"][0], chunk["text"])
+            for chunk in output.get("chunks", [])
+        ]) for output in outputs]
+
+    async def transcribe(self, path):
+        return (await self.transcribe_batch([path]))[0]
+
+    async def transcribe_batch(self, paths):
+        return await asyncio.to_thread(self.recognize_batch, paths)
+
+
+def load_audio(path):
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+        "-i", path,
+        "-f", "f32le", "-ac", "1", "-ar", str(LOCAL_SAMPLE_RATE),
+        "-"
+    ]
+    return np.frombuffer(subprocess.run(command, check=True, capture_output=True).stdout, dtype=np.float32)
+
+
+def save_audio(path, samples):
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "f32le", "-ac", "1", "-ar", str(LOCAL_SAMPLE_RATE),
+        "-i", "-",
+        "-c:a", "flac",
+        path
+    ]
+    subprocess.run(command, input=samples.astype(np.float32).tobytes(), check=True, capture_output=True)
+
+
+# Packs many short clips into one audio file, separated by silence, and sends that as a single request to the
+# wrapped backend. The transcript is split back per clip by the word timestamps (or evenly by duration when the
+# backend has none), so per request overhead is paid once per pack instead of once per clip. Packs stay within the
+# request limits of the wrapped backend, a batch that doesn't fit in one is sent as several requests
+class PackedTranscriber(Transcriber):
+    # Seconds of silence between two clips
+    gap = 1.0
+
+    def __init__(self, transcriber, clips_per_request):
+        super().__init__(concurrency=transcriber.concurrency, batch_size=clips_per_request)
+        self.transcriber = transcriber
+        self.rate_limiter = transcriber.rate_limiter
+        self.max_pack_seconds = transcriber.max_pack_seconds or float("inf")
+        self.max_pack_bytes = transcriber.max_pack_bytes or float("inf")
+        self.name = transcriber.name
+        # Split transcripts aren't always identical to per clip ones, so they are cached separately
+        self.model = f"{transcriber.model or 'default'}+packed"
+        self.warned = False
+
+    async def transcribe(self, path):
+        return await self.transcriber.transcribe(path)
+
+    async def transcribe_batch(self, paths):
+        clips = await asyncio.to_thread(lambda: [load_audio(path) for path in paths])
+
+        transcripts = []
+        start = 0
+        while start < len(clips):
+            # As many clips as fit in one request
+            end = start + 1
+            seconds = len(clips[start]) / LOCAL_SAMPLE_RATE
+            size = os.path.getsize(paths[start])
+            while end < len(clips):
+                seconds += self.gap + len(clips[end]) / LOCAL_SAMPLE_RATE
+                size += os.path.getsize(paths[end])
+                if seconds > self.max_pack_seconds or size > self.max_pack_bytes:
+                    break
+                end += 1
+
+            # transcribe_all waited for the first request of the batch, every further one needs its own turn
+            if start > 0:
+                await self.rate_limiter.wait()
+                metrics.add(requests=1)
+            if end - start == 1:
+                transcripts.append(await self.transcriber.transcribe(paths[start]))
+            else:
+                transcripts += await self.transcribe_pack(clips[start:end])
+            start = end
+        return transcripts
+
+    async def transcribe_pack(self, clips):
+        # Where every clip starts and ends in the pack, in ms
+        silence = np.zeros(int(self.gap * LOCAL_SAMPLE_RATE), dtype=np.float32)
+        offsets = []
+        position = 0
+        for clip in clips:
+            offsets.append((position, position + len(clip)))
+            position += len(clip) + len(silence)
+        samples = np.concatenate([part for clip in clips for part in (clip, silence)][:-1])
+        offsets = [(start * 1000 / LOCAL_SAMPLE_RATE, end * 1000 / LOCAL_SAMPLE_RATE) for start, end in offsets]
+        duration = len(samples) * 1000 / LOCAL_SAMPLE_RATE
+
+        with tempfile.TemporaryDirectory() as tmp_dir_path:
+            pack_path = os.path.join(tmp_dir_path, "pack.flac")
+            await asyncio.to_thread(save_audio, pack_path, samples)
+            transcript = await self.transcriber.transcribe(pack_path)
+
+        if not transcript.words and not self.warned:
+            print(f"{self.transcriber.name} doesn't return word timestamps, packed transcripts are split by duration")
+            self.warned = True
+
+        # Words spoken in a gap go to the closest clip
+        half_gap = self.gap * 500
+        return [
+            Transcript(transcript.slice(start - half_gap, end + half_gap, duration))
+            for start, end in offsets
+        ]
+
+    async def close(self):
+        await self.transcriber.close()
+
+
+# --backend picks the transcription backend, by default OpenAI Whisper if we have an API key, otherwise Google
+# Speech Recognition
+def get_transcriber(openai_api_key=None, backend=None, model=None, **kwargs):
+    if backend is None:
+        backend = "openai" if openai_api_key is not None else "google"
+    if backend not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Invalid backend {backend}, choose one of: {', '.join(TRANSCRIPTION_BACKENDS)}")
+
+    if backend == "local":
+        transcriber = LocalTranscriber(model, **kwargs)
+        print(f"Using local {transcriber.model} on the CPU for transcription")
+        return transcriber
+
+    if backend == "openai":
+        if openai_api_key is None:
+            raise ValueError("No OpenAI API Key found, run openai_authenticate first")
+        print("Using OpenAI Whisper API for transcription")
+        return OpenAITranscriber(openai_api_key, model, **kwargs)
+
+    print("Using Google Speech Recognition for transcription (no API key required)")
+    return GoogleTranscriber(**kwargs)
+
+
+# Transcribes every path with the transcribers worker pool. Results come back in the order of paths as
+# (transcript, error) tuples, on_result is called with (index, transcript, error) as soon as each one finishes.
+# With a TranscriptionCache, clips we already transcribed with this backend and model never hit the network
+async def transcribe_all(transcriber, paths, on_result=None, cache=None):
+    semaphore = asyncio.Semaphore(transcriber.concurrency)
+    results = [None] * len(paths)
+    keys = [None] * len(paths)
+
+    def finish(index, transcript, error):
+        results[index] = transcript, error
+        if keys[index] is not None and transcript and transcript.text:
+            cache.set(keys[index], transcript, os.path.getsize(paths[index]))
+        if on_result:
+            on_result(index, transcript, error)
+
+    pending = list(range(len(paths)))
+    if cache is not None:
+        keys = await asyncio.gather(*[
+            asyncio.to_thread(cache.get_key, path, transcriber.name, transcriber.model) for path in paths
+        ])
+        pending = []
+        for index, key in enumerate(keys):
+            transcript = cache.get(key)
+            if transcript is not None:
+                keys[index] = None
+                finish(index, transcript, None)
+            else:
+                pending.append(index)
+        metrics.add(cache_hits=len(paths) - len(pending))
+
+    async def worker(batch):
+        async with semaphore:
+            await transcriber.rate_limiter.wait()
+            metrics.add(requests=1)
+            try:
+                transcripts, error = await transcriber.transcribe_batch([paths[index] for index in batch]), None
+            except Exception as e:
+                transcripts, error = [None] * len(batch), e
+
+        for index, transcript in zip(batch, transcripts):
+            finish(index, transcript, error)
+
+    await asyncio.gather(*[
+        worker(pending[i:i + transcriber.batch_size]) for i in range(0, len(pending), transcriber.batch_size)
+    ])
+    return results
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from constants import artifacts_root_directory
+from transcription import Transcript
+
+# Upper bound for the stored transcriptions, least recently used ones are evicted past it
+DEFAULT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# The same audio transcribed with the same backend and model always gives us the same text, so transcriptions are
+# cached by a hash of the clip audio and re-used across runs and books instead of sending the clip again
+class TranscriptionCache:
+
+    def __init__(self, path=None, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.path = path or os.path.join(artifacts_root_directory, "cache", "transcriptions.sqlite3")
+        self.max_bytes = int(max_bytes)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transcriptions ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, "
+            "audio_bytes INTEGER NOT NULL, last_used REAL NOT NULL, words TEXT)"
+        )
+        # Caches created before word timestamps were stored
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(transcriptions)")]
+        if "words" not in columns:
+            self.connection.execute("ALTER TABLE transcriptions ADD COLUMN words TEXT")
+        self.connection.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def get_key(path, backend, model=None):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(data)
+        return f"{backend}|{model or 'default'}|{sha256.hexdigest()}"
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT text, audio_bytes, words FROM transcriptions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.connection.execute("UPDATE transcriptions SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        self.hits += 1
+        self.bytes_saved += row[1]
+        return Transcript(row[0], json.loads(row[2]) if row[2] else None)
+
+    def set(self, key, transcript, audio_bytes):
+        words = json.dumps(transcript.words) if transcript.words else None
+        self.connection.execute(
+            "INSERT OR REPLACE INTO transcriptions (key, text, size, audio_bytes, last_used, words) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, transcript.text, len(key) + len(transcript.text.encode()) + len(words or ""),
+             audio_bytes, time.time(), words))
+        self.evict()
+        self.connection.commit()
+
+    # Drops the least recently used entries until the cache fits in max_bytes again
+    def evict(self):
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM transcriptions").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+
+        rows = self.connection.execute("SELECT key, size FROM transcriptions ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM transcriptions WHERE key = ?", evicted)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return
+        print(
+            f"Transcription cache: {self.hits}/{lookups} hits ({int(self.hits / lookups * 100)}%), "
+            f"saved {self.hits} requests and {self.bytes_saved / (1024 * 1024):.1f} MB of uploads")
@@ -0,0 +1,5 @@
+# Command arguments arrive as strings (--mp3=true), this turns them into booleans
+def str_to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ["1", "true", "yes", "y", "on"]